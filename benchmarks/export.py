@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""Measures export throughput of :func:`unleash.git.export_tree`.
+
+Creates a packed repository containing a synthetic tree and exports it once
+per worker count, printing files per second. Usage::
+
+    python benchmarks/export.py [NUM_FILES] [WORKERS...]
+"""
+
+import sys
+import time
+
+from dulwich.objects import Blob, Tree
+from dulwich.repo import Repo
+from tempdir import TempDir
+
+from unleash.git import export_tree
+
+
+def build_tree(repo, num_files, files_per_dir=100):
+    objects = []
+    root = Tree()
+
+    for d in range(0, num_files, files_per_dir):
+        subtree = Tree()
+        for i in range(d, min(d + files_per_dir, num_files)):
+            blob = Blob.from_string('file {}\n'.format(i) * 64)
+            objects.append((blob, None))
+            subtree.add('file{}.txt'.format(i), 0o0100644, blob.id)
+        objects.append((subtree, None))
+        root.add('dir{}'.format(d // files_per_dir), 0o0040000, subtree.id)
+
+    objects.append((root, None))
+    repo.object_store.add_objects(objects)
+
+    return root
+
+
+def main():
+    num_files = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    worker_counts = [int(w) for w in sys.argv[2:]] or [1, 2, 4, 8, 16]
+
+    with TempDir() as repo_dir:
+        repo = Repo.init(repo_dir)
+        tree = build_tree(repo, num_files)
+        lookup = repo.object_store.__getitem__
+
+        for workers in worker_counts:
+            with TempDir() as out:
+                start = time.time()
+                export_tree(lookup, tree, out, workers=workers)
+                duration = time.time() - start
+
+            print('workers={:3d}: {:8.0f} files/s ({:.3f}s)'.format(
+                workers, num_files / duration, duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""Compares object backends: dulwich's object store and
+:class:`unleash.git.GitCatFileStore`.
+
+Creates a repository containing a synthetic tree, repacked by git so that
+the pack uses deltas like real-world ones, then reads every object once and
+exports the tree using each backend, printing the time taken. Usage::
+
+    python benchmarks/objects.py [NUM_FILES] [GIT_BINARY]
+"""
+
+import subprocess
+import sys
+import time
+
+from dulwich.repo import Repo
+from tempdir import TempDir
+
+from export import build_tree
+from unleash.git import GitCatFileStore, MalleableCommit, ObjectCache
+
+
+def all_ids(repo, tree):
+    ids = [tree.id]
+    for name, mode, sha in tree.iteritems():
+        ids.append(sha)
+        if mode & 0o0040000:
+            ids.extend(all_ids(repo, repo[sha])[1:])
+    return ids
+
+
+def run(name, repo, store, tree, ids):
+    start = time.time()
+    for sha in ids:
+        store[sha]
+    read_duration = time.time() - start
+
+    c = MalleableCommit(repo, tree=tree, objects=ObjectCache(store, 0))
+
+    start = time.time()
+    with TempDir() as out:
+        c.export_to(out)
+    export_duration = time.time() - start
+
+    print('{:10s}: read {:8.0f} objects/s ({:.3f}s), export {:.3f}s'.format(
+        name, len(ids) / read_duration, read_duration, export_duration))
+
+
+def main():
+    num_files = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    git_binary = sys.argv[2] if len(sys.argv) > 2 else 'git'
+
+    with TempDir() as repo_dir:
+        repo = Repo.init(repo_dir)
+        tree = build_tree(repo, num_files)
+
+        # repack only keeps reachable objects
+        c = MalleableCommit(repo, author='bench <bench@example.invalid>',
+                            message=u'bench', tree=tree)
+        repo.refs['refs/heads/master'] = c.save()
+        subprocess.check_call([git_binary, 'repack', '-adfq'],
+                              cwd=repo_dir)
+        repo = Repo(repo_dir)
+        ids = all_ids(repo, tree)
+
+        run('dulwich', repo, repo.object_store, tree, ids)
+
+        store = GitCatFileStore(repo, git_binary)
+        try:
+            run('cat-file', repo, store, tree, ids)
+        finally:
+            store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""Compares writing new objects loose and as a pack in
+:meth:`unleash.git.MalleableCommit.save`.
+
+Each run modifies ``NUM_FILES`` files spread over many directories in a
+fresh repository, then saves the commit. Usage::
+
+    python benchmarks/save.py [NUM_FILES]
+"""
+
+import sys
+import time
+
+from dulwich.repo import Repo
+from tempdir import TempDir
+
+from unleash.git import MalleableCommit
+
+
+def run(num_files, pack):
+    with TempDir() as repo_dir:
+        repo = Repo.init(repo_dir)
+
+        c = MalleableCommit(repo, author='bench <bench@example.invalid>',
+                            message=u'benchmark')
+        for i in range(num_files):
+            c.set_path_data('pkg{}/sub/__init__.py'.format(i),
+                            '__version__ = "1.0.{}"\n'.format(i))
+
+        # build the trees outside of the measurement
+        c.tree.id
+
+        start = time.time()
+        c.save(pack=pack)
+        return time.time() - start
+
+
+def main():
+    num_files = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    for pack in (False, True):
+        duration = run(num_files, pack)
+        print('{:5s}: {:.3f}s for {} files ({} objects)'.format(
+            'pack' if pack else 'loose', duration, num_files,
+            3 * num_files + 2))
+
+
+if __name__ == '__main__':
+    main()
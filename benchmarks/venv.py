@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""Compares creating virtualenvs from scratch with cloning them from a
+:class:`unleash.util.VirtualEnvPool` template.
+
+Creates a number of virtualenvs each way, installing a package into every
+one of them to check that it is usable, and prints the time taken. The time
+for the first clone includes creating the template. Usage::
+
+    python benchmarks/venv.py [NUM_ENVS] [PACKAGE]
+"""
+
+import sys
+import time
+
+from tempdir import TempDir
+
+from unleash.util import VirtualEnv, VirtualEnvPool
+
+
+def run(name, create, num_envs, package):
+    durations = []
+    for i in range(num_envs):
+        with TempDir() as tmpdir:
+            start = time.time()
+            ve = create(tmpdir)
+            durations.append(time.time() - start)
+
+            ve.pip_install(package)
+
+    print('{:10s}: first {:.2f}s, average of others {:.2f}s'.format(
+        name, durations[0], sum(durations[1:]) / max(1, num_envs - 1)))
+
+
+def main():
+    num_envs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    package = sys.argv[2] if len(sys.argv) > 2 else 'six'
+
+    run('scratch', VirtualEnv.create, num_envs, package)
+
+    with TempDir() as pool_dir:
+        pool = VirtualEnvPool(pool_dir)
+        run('pool', pool.clone, num_envs, package)
+
+
+if __name__ == '__main__':
+    main()
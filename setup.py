@@ -23,7 +23,7 @@ setup(
     packages=find_packages(exclude=['test']),
     install_requires=['click>=4.0', 'dulwich', 'logbook', 'tempdir>=0.6',
                       'virtualenv>=1.10.1', 'python-dateutil', 'versio',
-                      'stuf', 'pluginbase', 'networkx', 'werkzeug', 'pkginfo',
+                      'stuf', 'pluginbase', 'pkginfo',
                       'shutilwhich', 'jinja2'],
     entry_points={
         'console_scripts': [
@@ -0,0 +1,134 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+from pytest_fixbinary import binary
+from tempdir import TempDir
+
+import unleash
+
+git_binary = binary('git')
+
+# modules that take long to import, but are not needed to show help texts
+HEAVY_MODULES = ['dulwich', 'jinja2', 'virtualenv', 'pkginfo', 'versio',
+                 'networkx', 'dateutil', 'stuf', 'werkzeug']
+
+# records the time spent importing each module, similar to python 3.7's
+# ``-X importtime``, then runs the command-line interface
+RUNNER = '''
+import json, sys, time
+
+import __builtin__
+
+timings = []
+_import = __builtin__.__import__
+
+
+def timed_import(name, *args, **kwargs):
+    known = set(sys.modules)
+    start = time.time()
+    try:
+        return _import(name, *args, **kwargs)
+    finally:
+        if set(sys.modules) - known:
+            timings.append((name, time.time() - start))
+
+
+out_path = sys.argv[1]
+sys.argv = ['unleash'] + sys.argv[2:]
+error = None
+__builtin__.__import__ = timed_import
+try:
+    from unleash.cli import main
+    main()
+except SystemExit:
+    pass
+except Exception as e:
+    error = type(e).__name__
+finally:
+    __builtin__.__import__ = _import
+    with open(out_path, 'w') as out:
+        json.dump({'timings': timings,
+                   'error': error,
+                   'modules': [n for n, m in sys.modules.items()
+                               if m is not None]}, out)
+'''
+
+
+def run_cli(tmpdir, *args):
+    out = os.path.join(tmpdir, 'imports.json')
+    env = os.environ.copy()
+    env['XDG_CACHE_HOME'] = os.path.join(tmpdir, 'cache')
+    src = os.path.dirname(os.path.dirname(os.path.abspath(unleash.__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [src] + env.get('PYTHONPATH', '').split(os.pathsep))
+
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(
+            [sys.executable, '-c', RUNNER, out] + list(args),
+            env=env, stdout=devnull, cwd=tmpdir)
+
+    with open(out) as f:
+        return json.load(f)
+
+
+def heavy_imports(modules):
+    found = set()
+    for name in modules:
+        parts = name.split('.')
+        if parts[0] in HEAVY_MODULES:
+            found.add(parts[0])
+        # plugins are loaded into pluginbase's internal namespace, below a
+        # randomly named package
+        if parts[:2] == ['pluginbase', '_internalspace'] and len(parts) > 3:
+            found.add('plugin:' + '.'.join(parts[3:]))
+    return sorted(found)
+
+
+@pytest.mark.parametrize('args', [
+    ('--help', ),
+    ('release', '--help'),
+    ('publish', '--help'),
+])
+def test_help_skips_heavy_imports(args):
+    with TempDir() as tmpdir:
+        # the first run builds the plugin manifest, only the second one
+        # shows what a regular start imports
+        run_cli(tmpdir, *args)
+        result = run_cli(tmpdir, *args)
+
+    timings = sorted(result['timings'], key=lambda t: t[1], reverse=True)
+    print('slowest imports for unleash {}:'.format(' '.join(args)))
+    for name, duration in timings[:10]:
+        print('{:8.1f} ms  {}'.format(duration * 1000, name))
+
+    assert heavy_imports(result['modules']) == []
+
+
+def test_release_imports_only_plugins_it_runs(git_binary):
+    with TempDir() as tmpdir:
+        root = os.path.join(tmpdir, 'repo')
+        subprocess.check_call([git_binary, 'init', '-q', root])
+        open(os.path.join(root, 'README'), 'w').write('no setup.py')
+        subprocess.check_call([git_binary, 'add', 'README'], cwd=root)
+        subprocess.check_call([git_binary, '-c', 'user.name=pytest',
+                               '-c', 'user.email=py@test.inv', 'commit',
+                               '-q', '-m', 'initial'], cwd=root)
+        subprocess.check_call([git_binary, 'branch', '-M', 'master'],
+                              cwd=root)
+
+        # runs the group callback, opens the repository and calls the first
+        # hooks, which fail as there is no setup.py
+        args = ('--root', root, '--batch', 'release', '--author',
+                'pytest <py@test.inv>')
+        run_cli(tmpdir, *args)
+        result = run_cli(tmpdir, *args)
+
+    assert result['error'] is None
+    # packaging, docs and test plugins, and the heavy modules only they
+    # need, are not imported before their hooks run
+    assert heavy_imports(result['modules']) == [
+        'dateutil', 'dulwich', 'plugin:utils_assign', 'plugin:utils_tree',
+        'plugin:versions', 'stuf', 'versio']
@@ -72,3 +72,27 @@ def test_dag_enforced(dg):
 
     with pytest.raises(ValueError):
         dg.add_dependency('A', 'B')
+
+
+def test_failed_insertion_leaves_graph_untouched(dg):
+    order = dg.resolve_order()
+
+    with pytest.raises(ValueError):
+        dg.add_obj('G', ['D', 'G'])
+
+    with pytest.raises(ValueError):
+        dg.add_obj('A', ['F', 'D'])
+
+    assert dg.resolve_order() == order
+    assert dg.get_dependencies('A') == []
+    assert 'G' not in order
+
+
+def test_resolve_order_updated_on_change(dg):
+    dg.resolve_order()
+    dg.add_dependency('F', 'D')
+    ordered = dg.resolve_order()
+    assert ordered.index('F') > ordered.index('D')
+
+    dg.remove_obj('D')
+    assert 'D' not in dg.resolve_order()
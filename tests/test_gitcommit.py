@@ -1,10 +1,21 @@
 import os
 import subprocess
+import tarfile
+from types import ModuleType
 
+from dulwich.errors import NotBlobError, NotTreeError
 from dulwich.repo import Repo
 import pytest
 from tempdir import TempDir
-from unleash.git import MalleableCommit, export_tree, ResolvedRef
+from unleash import _context, commit, info
+from unleash.git import (MalleableCommit, export_tree, ResolvedRef,
+                         RefsSnapshot, TagIndex, ObjectCache,
+                         GitCatFileStore, diff_trees, update_working_copy)
+from unleash.exc import InvocationError
+from unleash.plugin import PluginGraph
+from unleash.plugins.utils_tree import changed_since, in_tmpexport
+from unleash.util import ExportCache
+from unleash.unleash import Unleash
 
 from pytest_fixbinary import binary
 
@@ -128,6 +139,80 @@ def test_commit_overwrites_files_with_dirs(repo):
     assert c.get_path_data('foo.txt') is None
 
 
+def test_commit_batches_edits(repo):
+    master = repo.refs['refs/heads/master']
+
+    c = MalleableCommit.from_existing(repo, master)
+    c.set_path_data('a/b/x', 'x')
+    c.set_path_data('a/b/y', 'y')
+    c.set_path_data('a/c', 'c')
+    c.set_path_data('foo.txt', 'replaced')
+    c.set_path_data('foo.txt/sub', 'now a dir')
+    c.set_path_data('sub/dir', 'file')
+
+    assert c.get_path_data('a/b/x') == 'x'
+    assert c.get_path_data('a/b/y') == 'y'
+    assert c.get_path_data('foo.txt/sub') == 'now a dir'
+    assert c.get_path_mode('foo.txt') == 0o0040000
+    assert c.get_path_data('sub/dir') == 'file'
+
+    # 6 blobs and the trees /, a, a/b, foo.txt and sub, each stored once
+    assert len(c.new_objects) == 11
+
+
+def test_commit_path_index(repo):
+    master = repo.refs['refs/heads/master']
+
+    c = MalleableCommit.from_existing(repo, master)
+    assert c.path_exists('sub/dir/dest.txt')
+    assert not c.path_exists('sub/dir/missing.txt')
+    assert not c.path_exists('foo.txt/below')
+
+    # further lookups are answered from the index
+    c._lookup_chain = {}
+    assert c.path_exists('sub/dir/dest.txt')
+    assert c.path_exists('sub//dir/')
+    assert c.get_path_mode('foo.txt') == 0o0100644
+    assert not c.path_exists('sub/nothere')
+
+
+def test_commit_path_index_invalidation(repo):
+    master = repo.refs['refs/heads/master']
+
+    c = MalleableCommit.from_existing(repo, master)
+    old_sub = c.get_path_id('sub')
+    assert c.path_exists('sub/dir/dest.txt')
+
+    c.set_path_data('sub/dir', 'file')
+    assert c.get_path_data('sub/dir') == 'file'
+    assert not c.path_exists('sub/dir/dest.txt')
+    assert c.get_path_id('sub') != old_sub
+    assert c.get_path_id('') == c.tree.id
+
+    c.set_path_data('foo.txt/x', 'x')
+    assert c.get_path_mode('foo.txt') == 0o0040000
+    assert c.get_path_data('foo.txt/x') == 'x'
+    assert c.get_path_data('foo.txt2') == 'second file'
+
+    c.set_path_id('sub', c.get_path_id('foo.txt'), 0o0040000)
+    assert c.get_path_data('sub/x') == 'x'
+    assert not c.path_exists('sub/dir')
+
+
+def test_commit_path_index_invalidates_unindexed_ancestors(repo):
+    master = repo.refs['refs/heads/master']
+
+    # pkg is never looked up before being replaced
+    c = MalleableCommit.from_existing(repo, master)
+    c.set_path_data('pkg/sub/f.py', 'old')
+    c.set_path_data('pkg', 'blob')
+
+    assert c.get_path_data('pkg') == 'blob'
+    assert not c.path_exists('pkg/sub/f.py')
+    with pytest.raises(NotTreeError):
+        c.get_path_data('pkg/sub/f.py')
+
+
 def test_commit_changes_mode(repo):
     master = repo.refs['refs/heads/master']
 
@@ -152,6 +237,71 @@ def test_commit_persists_changes(dummy_repo, repo):
     assert r[b_id].data == 'NEW'
 
 
+@pytest.mark.parametrize('pack', [False, True])
+def test_commit_persists_as_pack(dummy_repo, repo, pack):
+    master = repo.refs['refs/heads/master']
+    pack_dir = os.path.join(dummy_repo, '.git', 'objects', 'pack')
+    packs = set(os.listdir(pack_dir))
+
+    c = MalleableCommit.from_existing(repo, master)
+    c.set_path_data('new/xyz.txt', 'NEW')
+    commit_id = c.save(pack=pack)
+
+    assert (set(os.listdir(pack_dir)) != packs) == pack
+
+    r = Repo(dummy_repo)
+    c = MalleableCommit.from_existing(r, commit_id)
+    assert c.get_path_data('new/xyz.txt') == 'NEW'
+    assert c.get_path_data('foo.txt') == 'bar'
+
+
+def test_object_cache(repo):
+    master = repo.refs['refs/heads/master']
+    cache = ObjectCache(repo.object_store)
+
+    c = MalleableCommit.from_existing(repo, master, cache)
+    assert c.get_path_data('sub/dir/dest.txt') == 'baz'
+    misses = cache.misses
+
+    assert c.path_exists('sub/dir/dest.txt')
+    assert c.get_path_data('sub/dir/dest.txt') == 'baz'
+    assert cache.misses == misses
+    assert cache.hits > 0
+
+    # writes do not alter cached objects
+    root = cache[c.tree.id]
+    c.set_path_data('sub/new.txt', 'new')
+    assert c.get_path_data('sub/new.txt') == 'new'
+    assert 'new.txt' not in cache[root['sub'][1]]
+
+
+def test_object_cache_is_bounded(repo):
+    master = repo.refs['refs/heads/master']
+    tree = repo[repo[master].tree]
+    cache = ObjectCache(repo.object_store, max_size=tree.raw_length())
+
+    cache[tree.id]
+    assert cache.size == tree.raw_length()
+
+    # reading another object evicts the tree
+    cache[tree['foo.txt'][1]]
+    assert cache.size <= tree.raw_length()
+    assert tree.id not in cache._objects
+
+
+def test_object_cache_unlimited(repo):
+    master = repo.refs['refs/heads/master']
+    tree = repo[repo[master].tree]
+    cache = ObjectCache(repo.object_store, max_size=None)
+
+    blob = repo[tree['foo.txt'][1]]
+
+    cache[tree.id]
+    cache[blob.id]
+    assert tree.id in cache._objects
+    assert cache.size == tree.raw_length() + blob.raw_length()
+
+
 def test_export_to_existing(repo):
     master = repo.refs['refs/heads/master']
     c = repo[master]
@@ -284,3 +434,532 @@ def test_ref_tag_name_on_non_tag(repo):
     rr = ResolvedRef(repo, 'master')
 
     assert rr.tag_name is None
+
+
+def test_refs_snapshot(repo):
+    refs = RefsSnapshot(repo)
+    master = repo.refs['refs/heads/master']
+
+    assert refs.resolve('master') == ['refs/heads/master']
+    assert refs.resolve('heads/master') == ['refs/heads/master']
+    assert refs.resolve('refs/tags/one_tag') == ['refs/tags/one_tag']
+    assert refs.resolve('nope') == []
+    assert refs['HEAD'] == master
+    assert refs.symref_target('HEAD') == 'refs/heads/master'
+
+    # writing through the snapshot invalidates it
+    refs['refs/tags/master'] = repo[master].parents[0]
+    assert repo.refs['refs/tags/master'] == repo[master].parents[0]
+
+    rr = ResolvedRef(repo, 'master', refs=refs)
+    assert rr.full_name == ['refs/tags/master', 'refs/heads/master']
+
+    # changes made behind its back are not seen until invalidated
+    repo.refs['refs/heads/other'] = master
+    assert not ResolvedRef(repo, 'other', refs=refs).found
+
+    refs.invalidate()
+    assert ResolvedRef(repo, 'other', refs=refs).id == master
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_export_many_files(repo, workers):
+    master = repo.refs['refs/heads/master']
+    c = MalleableCommit.from_existing(repo, master)
+
+    for i in range(50):
+        c.set_path_data('many/{}/file.txt'.format(i % 7), str(i))
+        c.set_path_data('many/f{}.txt'.format(i), str(i), mode=0o0100755)
+
+    with TempDir() as outdir:
+        c.export_to(outdir, workers=workers)
+
+        for i in range(50):
+            fn = os.path.join(outdir, 'many', 'f{}.txt'.format(i))
+            assert open(fn).read() == str(i)
+            assert os.stat(fn).st_mode & 0o777 == 0o755
+
+        assert 'baz' == open(os.path.join(outdir, 'sub', 'dir',
+                                          'dest.txt')).read()
+
+
+def snapshot_dir(path):
+    rv = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            fn = os.path.join(dirpath, name)
+            st = os.lstat(fn)
+            data = None if os.path.isdir(fn) else open(fn).read()
+            rv[os.path.relpath(fn, path)] = (st.st_mode, data)
+    return rv
+
+
+def test_export_update(repo):
+    master = repo.refs['refs/heads/master']
+    c = MalleableCommit.from_existing(repo, master)
+    base_tree_id = c.tree.id
+
+    c.set_path_data('foo.txt', 'changed')
+    c.set_path_data('foo.txt2', 'second file', mode=0o0100755)
+    c.set_path_data('sub/dir', 'no longer a dir')
+    c.set_path_data('new/dir/file', 'new')
+
+    with TempDir() as updated, TempDir() as fresh:
+        export_tree(repo.object_store.__getitem__, repo[base_tree_id],
+                    updated)
+        c.export_to(updated, base_tree_id=base_tree_id)
+        c.export_to(fresh)
+
+        assert snapshot_dir(updated) == snapshot_dir(fresh)
+
+
+def test_export_update_removes_files(repo):
+    master = repo[repo.refs['refs/heads/master']]
+    c = MalleableCommit.from_existing(repo, master.parents[0])
+
+    with TempDir() as outdir:
+        export_tree(repo.object_store.__getitem__, repo[master.tree], outdir)
+        assert os.path.exists(os.path.join(outdir, 'foo.txt2'))
+
+        c.export_to(outdir, base_tree_id=master.tree)
+        assert not os.path.exists(os.path.join(outdir, 'foo.txt2'))
+        assert os.path.exists(os.path.join(outdir, 'foo.txt'))
+
+
+def test_export_update_mode_change_keeps_hardlinks(repo):
+    master = repo.refs['refs/heads/master']
+    c = MalleableCommit.from_existing(repo, master)
+    base_tree_id = c.tree.id
+    c.set_path_data('foo.txt', 'bar', mode=0o0100755)
+
+    with TempDir() as outdir, TempDir() as linked:
+        export_tree(repo.object_store.__getitem__, repo[base_tree_id],
+                    outdir)
+        os.link(os.path.join(outdir, 'foo.txt'),
+                os.path.join(linked, 'foo.txt'))
+
+        c.export_to(outdir, base_tree_id=base_tree_id)
+        assert os.stat(os.path.join(outdir, 'foo.txt')).st_mode & 0o111
+        assert not os.stat(os.path.join(linked, 'foo.txt')).st_mode & 0o111
+
+
+def test_export_cache_unsaved_trees(repo):
+    master = repo.refs['refs/heads/master']
+    a = MalleableCommit.from_existing(repo, master)
+    a.set_path_data('foo.txt', 'first')
+    b = MalleableCommit.from_existing(repo, master)
+    b.set_path_data('foo.txt', 'second')
+
+    cache = ExportCache()
+    try:
+        with TempDir() as first, TempDir() as second, TempDir() as fresh:
+            cache.export(a, first)
+            # the tree of a is unknown to b, which must not use it as base
+            cache.export(b, second)
+            b.export_to(fresh)
+
+            assert open(os.path.join(first, 'foo.txt')).read() == 'first'
+            assert snapshot_dir(second) == snapshot_dir(fresh)
+    finally:
+        cache.close()
+
+
+def test_export_archive(repo):
+    master = repo.refs['refs/heads/master']
+    c = MalleableCommit.from_existing(repo, master)
+    c.set_path_data('run.sh', 'echo', mode=0o0100755)
+    c.set_path_data('link', 'foo.txt', mode=0o0120000)
+
+    with TempDir() as outdir:
+        fn = os.path.join(outdir, 'out.tar.gz')
+        with open(fn, 'wb') as out:
+            c.export_archive(out, prefix='pkg-1.0/',
+                             extra_files={'PKG-INFO': 'Name: pkg\n'})
+
+        tar = tarfile.open(fn)
+        members = {m.name: m for m in tar.getmembers()}
+
+        assert members['pkg-1.0'].isdir()
+        assert members['pkg-1.0/sub/dir'].isdir()
+        assert tar.extractfile('pkg-1.0/sub/dir/dest.txt').read() == 'baz'
+        assert tar.extractfile('pkg-1.0/PKG-INFO').read() == 'Name: pkg\n'
+        assert members['pkg-1.0/foo.txt'].mode == 0o644
+        assert members['pkg-1.0/run.sh'].mode == 0o755
+        assert members['pkg-1.0/link'].issym()
+        assert members['pkg-1.0/link'].linkname == 'foo.txt'
+        assert members['pkg-1.0/foo.txt'].mtime == c.commit_time
+
+
+def test_export_sparse(repo):
+    master = repo.refs['refs/heads/master']
+    c = MalleableCommit.from_existing(repo, master)
+    c.set_path_data('pkg/__init__.py', '')
+    c.set_path_data('pkg/data/blob.bin', 'data')
+    c.set_path_data('fixtures/large/x.py', '')
+
+    looked_up = set()
+
+    def lookup(sha):
+        looked_up.add(sha)
+        return c._lookup_chain[sha]
+
+    with TempDir() as outdir:
+        export_tree(lookup, c.tree, outdir,
+                    paths=['foo.txt', 'pkg/*.py', 'sub'])
+
+        assert sorted(snapshot_dir(outdir)) == [
+            'foo.txt', 'pkg', 'pkg/__init__.py', 'sub', 'sub/dir',
+            'sub/dir/dest.txt'
+        ]
+
+    # subtrees that cannot match are never read
+    assert c.get_path_id('fixtures') not in looked_up
+
+
+def test_path_globs():
+    from unleash.git import PathGlobs
+
+    g = PathGlobs(['setup.py', 'docs', '**/*.py'])
+
+    assert g.matches(('setup.py',))
+    assert g.matches(('docs',))
+    assert g.matches(('a', 'b', 'c.py'))
+    assert not g.matches(('a', 'b', 'c.txt'))
+    assert g.may_match_below(('a', 'b'))
+
+    g = PathGlobs(['pkg/*.py'])
+    assert g.may_match_below(('pkg',))
+    assert not g.may_match_below(('other',))
+    assert not g.may_match_below(('pkg', 'sub'))
+
+    assert g == PathGlobs(['pkg/*.py'])
+    assert g != PathGlobs(['pkg/*.txt'])
+
+
+def test_export_honors_gitattributes(repo):
+    master = repo.refs['refs/heads/master']
+    c = MalleableCommit.from_existing(repo, master)
+    c.set_path_data('.gitattributes', '# comment\n'
+                                      '*.bin export-ignore\n'
+                                      'sub export-ignore\n'
+                                      'keep/*.bin -export-ignore\n')
+    c.set_path_data('data/a.bin', 'a')
+    c.set_path_data('keep/b.bin', 'b')
+    c.set_path_data('other/.gitattributes', 'big.txt export-ignore\n')
+    c.set_path_data('other/big.txt', 'big')
+    c.set_path_data('big.txt', 'big')
+
+    with TempDir() as full, TempDir() as outdir:
+        # only archive-like exports leave out files
+        c.export_to(full)
+        assert 'data/a.bin' in snapshot_dir(full)
+
+        c.export_to(outdir, export_ignore=True)
+
+        assert sorted(snapshot_dir(outdir)) == [
+            '.gitattributes', 'big.txt', 'data', 'foo.txt', 'foo.txt2',
+            'keep', 'keep/b.bin', 'other', 'other/.gitattributes'
+        ]
+
+        fn = os.path.join(outdir, 'out.tar')
+        with open(fn, 'wb') as out:
+            c.export_archive(out, compression='')
+        names = tarfile.open(fn).getnames()
+        assert 'data/a.bin' not in names
+        assert 'keep/b.bin' in names
+
+
+def test_export_max_file_size(repo):
+    master = repo.refs['refs/heads/master']
+    c = MalleableCommit.from_existing(repo, master)
+    c.set_path_data('large.txt', 'x' * 100)
+
+    with TempDir() as outdir:
+        c.export_to(outdir, max_file_size=10)
+        assert not os.path.exists(os.path.join(outdir, 'large.txt'))
+        assert os.path.exists(os.path.join(outdir, 'foo.txt'))
+
+
+def test_export_update_gitattributes_change(repo):
+    master = repo.refs['refs/heads/master']
+    c = MalleableCommit.from_existing(repo, master)
+    base_tree_id = c.tree.id
+
+    c.set_path_data('.gitattributes', 'dest.txt export-ignore\n')
+
+    with TempDir() as updated, TempDir() as fresh:
+        export_tree(repo.object_store.__getitem__, repo[base_tree_id],
+                    updated)
+        c.export_to(updated, base_tree_id=base_tree_id, export_ignore=True)
+        c.export_to(fresh, export_ignore=True)
+
+        assert snapshot_dir(updated) == snapshot_dir(fresh)
+        assert not os.path.exists(os.path.join(fresh, 'sub', 'dir',
+                                               'dest.txt'))
+
+
+def test_tag_index(git_binary, dummy_repo, repo):
+    master = repo[repo.refs['refs/heads/master']]
+    first = repo[master.parents[0]]
+
+    # make sure the commit times differ
+    c = MalleableCommit.from_existing(repo, first.id)
+    c.commit_time = master.commit_time - 10
+    repo.refs['refs/tags/0.1'] = c.save()
+
+    subprocess.check_call([git_binary, 'tag', '-a', '-m', 'annotated',
+                           '0.2', master.id], cwd=dummy_repo)
+
+    refs = RefsSnapshot(repo)
+    idx = TagIndex(repo, refs)
+
+    assert idx.tags['refs/tags/0.2']['commit'] == master.id
+    assert idx.tags['refs/tags/0.2']['version'] == '0.2'
+    assert idx.tags['refs/tags/one_tag']['version'] is None
+    assert idx.newest() in ('refs/tags/0.2', 'refs/tags/one_tag')
+    assert os.path.exists(os.path.join(dummy_repo, '.git', 'unleash',
+                                       'tags.json'))
+
+    # newer tags are picked up incrementally
+    c = MalleableCommit.from_existing(repo, master.id)
+    c.commit_time = master.commit_time + 10
+    refs['refs/tags/0.3'] = c.save()
+    del repo.refs['refs/tags/0.1']
+    refs.invalidate()
+
+    idx = TagIndex(repo, refs)
+    assert idx.newest() == 'refs/tags/0.3'
+    assert 'refs/tags/0.1' not in idx.tags
+
+
+def test_commit_diff(repo):
+    master = repo.refs['refs/heads/master']
+
+    c = MalleableCommit.from_existing(repo, master)
+    old_foo = c.get_path_id('foo.txt')
+    c.set_path_data('foo.txt', 'changed')
+    c.set_path_data('sub/dir', 'now a file')
+    c.set_path_data('docs/index.rst', 'docs')
+
+    changes = list(c.diff(master))
+    assert [path for path, old, new in changes] == [
+        'docs/index.rst', 'foo.txt', 'sub/dir', 'sub/dir/dest.txt']
+    assert changes[1][1] == (0o0100644, old_foo)
+    assert changes[1][2] == (0o0100644, c.get_path_id('foo.txt'))
+    assert changes[3][2] is None
+
+    assert c.has_changes(master, ['docs'])
+    assert c.has_changes(repo[master].tree, ['sub/**/*.txt'])
+    assert not c.has_changes(master, ['foo.txt2', 'other'])
+    assert len(list(c.diff(None))) == 4
+
+
+def test_changed_since(git_binary, dummy_repo, repo):
+    master = repo.refs['refs/heads/master']
+    subprocess.check_call([git_binary, 'tag', '-a', '-m', 'annotated',
+                           '1.0', master], cwd=dummy_repo)
+
+    c = MalleableCommit.from_existing(repo, master)
+    c.set_path_data('docs/index.rst', 'docs')
+
+    _context.push({'commit': c})
+    try:
+        assert changed_since('1.0', ['docs'])
+        assert not changed_since('1.0', ['sub'])
+        assert not changed_since('one_tag', ['foo.txt'])
+
+        with pytest.raises(InvocationError):
+            changed_since('no-such-ref')
+
+        repo.refs['refs/tags/master'] = master
+        with pytest.raises(InvocationError):
+            changed_since('master')
+    finally:
+        _context.pop()
+
+
+def test_diff_trees_skips_identical_subtrees(repo):
+    master = repo.refs['refs/heads/master']
+
+    c = MalleableCommit.from_existing(repo, master)
+    c.set_path_data('foo.txt', 'changed')
+
+    looked_up = []
+
+    def lookup(sha):
+        looked_up.append(sha)
+        return repo[sha]
+
+    old_tree = repo[repo[master].tree]
+    changes = list(diff_trees(lookup, old_tree, c.tree))
+    assert [path for path, old, new in changes] == ['foo.txt']
+    assert looked_up == []
+
+
+@pytest.yield_fixture
+def cat_file_store(git_binary, repo):
+    store = GitCatFileStore(repo, git_binary)
+    yield store
+    store.close()
+
+
+def test_cat_file_store(repo, cat_file_store):
+    master = repo.refs['refs/heads/master']
+    tree_id = repo[master].tree
+
+    for sha in [master, tree_id]:
+        obj = cat_file_store[sha]
+        assert obj.id == sha
+        assert obj.as_raw_string() == repo[sha].as_raw_string()
+
+    with pytest.raises(KeyError):
+        cat_file_store['0' * 40]
+
+    assert tree_id in cat_file_store
+    assert '0' * 40 not in cat_file_store
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_export_with_cat_file_store(repo, cat_file_store, workers):
+    master = repo.refs['refs/heads/master']
+
+    c = MalleableCommit.from_existing(repo, master,
+                                      ObjectCache(cat_file_store))
+    c.set_path_data('new.txt', 'new')
+
+    with TempDir() as a, TempDir() as b:
+        c.export_to(a, workers=workers)
+        MalleableCommit.from_existing(repo, master).export_to(b)
+
+        open(os.path.join(b, 'new.txt'), 'w').write('new')
+        assert snapshot_dir(a) == snapshot_dir(b)
+
+
+def test_commit_stream_blobs(repo):
+    master = repo.refs['refs/heads/master']
+    c = MalleableCommit.from_existing(repo, master)
+
+    # > 1 chunk, incompressible enough to exercise partial decompression
+    data = ''.join(str(i * 7919 % 104729) for i in range(100000))
+
+    with c.open_path_writer('big.txt') as f:
+        for i in range(0, len(data), 1000):
+            f.write(data[i:i + 1000])
+
+    # nothing is written to the repository before the commit is saved
+    assert c.get_path_id('big.txt') == f.id
+    assert f.id in c.new_objects
+    assert f.id not in repo.object_store
+
+    with c.open_path('big.txt', chunk_size=4096) as r:
+        assert r.read(10) == data[:10]
+        assert r.read() == data[10:]
+
+    with TempDir() as outdir:
+        c.export_to(outdir)
+        assert open(os.path.join(outdir, 'big.txt')).read() == data
+
+    c.save(pack=True)
+    assert repo[f.id].data == data
+    assert not [name for name in os.listdir(repo.object_store.path)
+                if name.startswith('tmp_obj_')]
+
+    c.set_path_data('small.txt', 'small')
+    assert c.open_path('small.txt').read() == 'small'
+    assert c.open_path('sub/dir/dest.txt').read() == 'baz'
+
+    with pytest.raises(NotBlobError):
+        c.open_path('sub').read()
+
+
+def test_cat_file_store_stream_blobs(repo, cat_file_store):
+    master = repo.refs['refs/heads/master']
+    c = MalleableCommit.from_existing(repo, master,
+                                      ObjectCache(cat_file_store))
+
+    assert c.open_path('foo.txt').read() == 'bar'
+
+    with c.open_path_writer('new.txt') as f:
+        f.write('new')
+    assert c.open_path('new.txt').read() == 'new'
+
+
+def test_update_working_copy(git_binary, dummy_repo, repo):
+    master = repo.refs['refs/heads/master']
+    old_tree = repo[master].tree
+    unchanged = os.path.join(dummy_repo, 'foo.txt2')
+    mtime = int(os.stat(unchanged).st_mtime) - 100
+    os.utime(unchanged, (mtime, mtime))
+
+    c = MalleableCommit.from_existing(repo, master)
+    c.parent_ids = [master]
+    c.set_path_data('foo.txt', 'changed')
+    c.set_path_data('sub', 'now a file')
+    c.set_path_data('new/file.sh', 'echo', mode=0o0100755)
+    repo.refs['refs/heads/master'] = c.save()
+
+    assert update_working_copy(repo, old_tree, c.tree.id) == 4
+
+    assert open(os.path.join(dummy_repo, 'foo.txt')).read() == 'changed'
+    assert open(os.path.join(dummy_repo, 'sub')).read() == 'now a file'
+    assert os.access(os.path.join(dummy_repo, 'new', 'file.sh'), os.X_OK)
+    assert os.stat(unchanged).st_mtime == mtime
+
+    status = subprocess.check_output([git_binary, 'status', '--porcelain'],
+                                     cwd=dummy_repo)
+    assert status == ''
+
+
+def test_publish_newest_annotated_tag(git_binary, dummy_repo, repo):
+    master = repo[repo.refs['refs/heads/master']]
+
+    # newer than the lightweight tag on master
+    c = MalleableCommit.from_existing(repo, master.id)
+    c.commit_time = master.commit_time + 10
+    c.set_path_data('foo.txt', 'released')
+    release = c.save()
+    subprocess.check_call([git_binary, 'tag', '-a', '-m', 'annotated',
+                           '1.0', release], cwd=dummy_repo)
+
+    published = []
+
+    def publish_release():
+        published.append((commit.get_path_data('foo.txt'),
+                          info['ref'].tag_name))
+
+    plugin = ModuleType('recorder')
+    plugin.PLUGIN_NAME = 'recorder'
+    plugin.PLUGIN_DEPENDS = []
+    plugin.publish_release = publish_release
+    plugins = PluginGraph()
+    plugins.add_plugin(plugin)
+
+    _context.push({'opts': {'root': dummy_repo, 'object_cache_size': 0}})
+    try:
+        unleash = Unleash(plugins)
+        unleash._init_repo()
+        unleash.publish(None)
+    finally:
+        _context.pop()
+
+    assert published == [('released', '1.0')]
+
+
+def test_in_tmpexport_uses_plugin_export_paths(repo):
+    master = repo.refs['refs/heads/master']
+    c = MalleableCommit.from_existing(repo, master)
+
+    plugin = ModuleType('sparse')
+    plugin.PLUGIN_EXPORT_PATHS = ['foo.txt', 'sub/**/*.txt']
+
+    _context.push({'export_cache': ExportCache(0), 'current_plugin': plugin})
+    try:
+        with in_tmpexport(c) as td:
+            files = {path: data for path, (mode, data)
+                     in snapshot_dir(td).items() if data is not None}
+            assert files == {'foo.txt': 'bar', 'sub/dir/dest.txt': 'baz'}
+
+        with in_tmpexport(c, sparse=False) as td:
+            assert 'foo.txt2' in snapshot_dir(td)
+    finally:
+        _context.pop()
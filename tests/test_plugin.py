@@ -0,0 +1,181 @@
+import json
+import os
+import threading
+from types import ModuleType
+
+import click
+import pytest
+from tempdir import TempDir
+
+from unleash import _context, current_plugin, opts
+from unleash.plugin import LazyPlugin, PluginGraph
+from unleash.plugins.utils_tree import in_tmpexport
+from unleash.util import ExportCache
+
+
+def make_plugin(name, depends=[], hook=None):
+    mod = ModuleType(name)
+    mod.PLUGIN_NAME = name
+    mod.PLUGIN_DEPENDS = depends
+    if hook is not None:
+        mod.lint_release = hook
+    return mod
+
+
+@pytest.yield_fixture
+def context():
+    _context.push({'opts': {'value': 'from context'}})
+    yield
+    _context.pop()
+
+
+def make_graph(workers, plugins):
+    g = PluginGraph()
+    g.workers = workers
+    for p in plugins:
+        g.add_plugin(p)
+    return g
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_notify_respects_dependencies(context, workers):
+    calls = []
+    lock = threading.Lock()
+
+    def hook():
+        with lock:
+            calls.append(current_plugin.PLUGIN_NAME)
+        return current_plugin.PLUGIN_NAME, opts['value']
+
+    g = make_graph(workers, [
+        make_plugin('a', hook=hook),
+        make_plugin('b', ['a'], hook=hook),
+        make_plugin('c', ['a']),
+        make_plugin('d', ['b', 'c'], hook=hook),
+    ])
+
+    rvs = g.notify('lint_release')
+    assert rvs == [(name, 'from context') for name in ['a', 'b', 'd']]
+    assert calls == ['a', 'b', 'd']
+
+
+def test_notify_runs_independent_hooks_concurrently(context):
+    started = threading.Event()
+
+    def first():
+        # only returns if the second hook runs at the same time
+        assert started.wait(5)
+
+    def second():
+        started.set()
+
+    g = make_graph(2, [make_plugin('first', hook=first),
+                       make_plugin('second', hook=second)])
+    g.notify('lint_release')
+
+
+def test_notify_stops_on_error(context):
+    calls = []
+
+    def fail():
+        raise ValueError('broken')
+
+    def never():
+        calls.append('never')
+
+    g = make_graph(4, [make_plugin('fail', hook=fail),
+                       make_plugin('after', ['fail'], hook=never)])
+
+    with pytest.raises(ValueError):
+        g.notify('lint_release')
+    assert calls == []
+
+
+class EmptyCommit(object):
+    def export_to(self, path, **kwargs):
+        pass
+
+
+@pytest.mark.parametrize('workers,changes_dir', [(1, True), (2, False)])
+def test_in_tmpexport_changes_directory_when_serial(workers, changes_dir):
+    cwd = os.getcwd()
+
+    def hook():
+        with in_tmpexport(EmptyCommit()) as td:
+            return os.getcwd() == os.path.realpath(td)
+
+    _context.push({'export_cache': ExportCache(0)})
+    try:
+        g = make_graph(workers, [make_plugin('a', hook=hook)])
+        assert g.notify('lint_release') == [changes_dir]
+    finally:
+        _context.pop()
+
+    assert os.getcwd() == cwd
+
+
+def make_cli():
+    group = click.Group('cli')
+    for name in ['release', 'publish']:
+        group.add_command(click.Command(name))
+    return group
+
+
+def option_names(cli):
+    names = sorted(p.name for p in cli.params)
+    for command in sorted(cli.commands):
+        names.extend(sorted(p.name for p in cli.commands[command].params))
+    return names
+
+
+def test_plugin_manifest():
+    with TempDir() as tmpdir:
+        manifest_path = os.path.join(tmpdir, 'plugins.json')
+
+        eager = PluginGraph()
+        eager.collect_plugins()
+        eager_cli = make_cli()
+        eager.notify('setup', eager_cli)
+
+        # the first run builds the manifest, the second one only reads it
+        for i in range(2):
+            g = PluginGraph()
+            g.collect_plugins(make_cli(), manifest_path)
+            assert os.path.exists(manifest_path)
+
+        plugin = g.plugin_mods['git']
+        assert isinstance(plugin, LazyPlugin)
+        assert sorted(g.plugin_mods) == sorted(eager.plugin_mods)
+        assert g.resolve_order() == eager.resolve_order()
+
+        cli = make_cli()
+        g.notify('setup', cli)
+        assert option_names(cli) == option_names(eager_cli)
+        assert plugin._module is None
+
+        assert plugin.PLUGIN_DEPENDS == []
+        assert g.plugin_mods['egg_info'].PLUGIN_EXPORT_PATHS ==\
+            eager.plugin_mods['egg_info'].PLUGIN_EXPORT_PATHS
+        assert getattr(plugin, 'lint_release', None) is None
+
+        assert callable(plugin.collect_info)
+        assert plugin._module is None
+        assert plugin.PLUGIN_NAME == plugin.load().PLUGIN_NAME
+
+
+def test_plugin_manifest_rebuilt_on_change():
+    with TempDir() as tmpdir:
+        manifest_path = os.path.join(tmpdir, 'plugins.json')
+
+        g = PluginGraph()
+        g.collect_plugins(make_cli(), manifest_path)
+
+        # simulate a changed plugin file
+        manifest = json.load(open(manifest_path))
+        manifest['key']['files'][1][2] += 1
+        manifest['plugins'] = []
+        json.dump(manifest, open(manifest_path, 'w'))
+
+        g = PluginGraph()
+        g.collect_plugins(make_cli(), manifest_path)
+        assert 'git' in g.plugin_mods
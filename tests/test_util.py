@@ -0,0 +1,393 @@
+import json
+import os
+import subprocess
+import time
+
+import pytest
+from tempdir import TempDir
+from unleash import _context, opts
+from unleash.util import (BackgroundTask, CommandTask, ExportCache,
+                          OutputTail, VirtualEnv, VirtualEnvPool, Wheelhouse,
+                          run_command)
+
+
+class FakeTree(object):
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeCommit(object):
+    def __init__(self, tree_id, files):
+        self.tree = FakeTree(tree_id)
+        self.files = files
+        self.exports = 0
+
+    def has_object(self, hexsha):
+        return True
+
+    def export_to(self, path, base_tree_id=None, **kwargs):
+        self.exports += 1
+        for name in os.listdir(path):
+            os.unlink(os.path.join(path, name))
+
+        for name, data in self.files.items():
+            with open(os.path.join(path, name), 'wb') as f:
+                f.write(data)
+
+
+@pytest.yield_fixture
+def cache():
+    c = ExportCache()
+    yield c
+    c.close()
+
+
+def read_export(cache, commit):
+    with TempDir() as dest:
+        cache.export(commit, dest)
+        return {name: open(os.path.join(dest, name)).read()
+                for name in os.listdir(dest)}
+
+
+def test_export_cache_exports_once(cache):
+    c = FakeCommit('a' * 40, {'foo.txt': 'foo', 'bar.txt': 'bar'})
+
+    assert read_export(cache, c) == {'foo.txt': 'foo', 'bar.txt': 'bar'}
+    assert read_export(cache, c) == {'foo.txt': 'foo', 'bar.txt': 'bar'}
+    assert c.exports == 1
+
+
+@pytest.mark.parametrize('link', [False, True])
+def test_export_cache_copies_are_private(link):
+    cache = ExportCache(link=link)
+    c = FakeCommit('a' * 40, {'foo.txt': 'foo'})
+
+    try:
+        with TempDir() as dest:
+            cache.export(c, dest)
+            os.unlink(os.path.join(dest, 'foo.txt'))
+            open(os.path.join(dest, 'foo.txt'), 'w').write('changed')
+
+        assert read_export(cache, c) == {'foo.txt': 'foo'}
+    finally:
+        cache.close()
+
+
+def test_export_cache_evicts_least_recently_used():
+    cache = ExportCache(max_size=6)
+    a = FakeCommit('a' * 40, {'a': 'aaa'})
+    b = FakeCommit('b' * 40, {'b': 'bbb'})
+    c = FakeCommit('c' * 40, {'c': 'ccc'})
+
+    try:
+        read_export(cache, a)
+        read_export(cache, b)
+        read_export(cache, a)
+        read_export(cache, c)
+        assert cache.size == 6
+
+        # b was least recently used and must have been evicted
+        read_export(cache, a)
+        read_export(cache, b)
+        assert (a.exports, b.exports, c.exports) == (1, 2, 1)
+    finally:
+        cache.close()
+
+
+def test_export_cache_disabled():
+    cache = ExportCache(max_size=0)
+    c = FakeCommit('a' * 40, {'foo.txt': 'foo'})
+
+    assert read_export(cache, c) == {'foo.txt': 'foo'}
+    assert read_export(cache, c) == {'foo.txt': 'foo'}
+    assert c.exports == 2
+
+
+def has_virtualenv_api():
+    try:
+        import virtualenv
+    except ImportError:
+        return False
+    return hasattr(virtualenv, 'make_environment_relocatable')
+
+
+@pytest.mark.skipif(not has_virtualenv_api(),
+                    reason='requires virtualenv < 20')
+def test_venv_pool_clones_template():
+    with TempDir() as pool_dir, TempDir() as a, TempDir() as b:
+        pool = VirtualEnvPool(pool_dir)
+        ve_a = pool.clone(a)
+        ve_b = pool.clone(b)
+
+        # a single template, plus its metadata, was created. both clones
+        # are separate from it
+        assert len(os.listdir(pool_dir)) == 2
+        prefix = ve_b.check_output([ve_b.python, '-c',
+                                    'import sys; print(sys.prefix)'])
+        assert os.path.realpath(prefix.strip()) == os.path.realpath(b)
+        assert ve_a.path == a
+
+
+def test_venv_pool_copies_existing_template():
+    with TempDir() as pool_dir, TempDir() as dest:
+        pool = VirtualEnvPool(pool_dir)
+        key = pool._key(['tox'])
+        template = os.path.join(pool_dir, key)
+        origin = '/tmp/where-the-template-was-created'
+
+        os.makedirs(os.path.join(template, 'bin'))
+        open(os.path.join(template, 'bin', 'python'), 'w').write('python')
+        os.symlink(origin + '/bin', os.path.join(template, 'local'))
+        os.symlink('/usr/bin/env', os.path.join(template, 'env'))
+
+        meta_path = os.path.join(pool_dir, key + '.json')
+        with open(meta_path, 'w') as f:
+            json.dump({'requirements': ['tox'], 'created': time.time(),
+                       'origin': origin, 'size': 6}, f)
+        os.utime(meta_path, (0, 0))
+
+        ve = pool.clone(dest, ['tox'])
+
+        assert ve.path == dest
+        assert open(os.path.join(dest, 'bin', 'python')).read() == 'python'
+        # only links into the template's origin are pointed at the copy
+        assert os.readlink(os.path.join(dest, 'local')) == dest + '/bin'
+        assert os.readlink(os.path.join(dest, 'env')) == '/usr/bin/env'
+        assert os.readlink(os.path.join(template, 'local')) == \
+            origin + '/bin'
+        # using a template marks it as recently used
+        assert os.path.getmtime(meta_path) > 0
+
+
+def test_venv_pool_normalizes_requirements():
+    assert VirtualEnvPool.normalize_requirements(
+        ['Sphinx', 'sphinx_rtd_theme', 'tox >= 2.0', 'sphinx']) ==\
+        ['sphinx', 'sphinx-rtd-theme', 'tox>=2.0']
+
+    assert VirtualEnvPool.normalize_requirements([
+        'Zope.Interface [Foo_Bar] >= 4; python_version < "3"',
+        'git+https://github.com/Foo/Bar_Baz.git#egg=Bar_Baz',
+        'https://example.com/Foo_Bar-1.0.tar.gz',
+        'Foo_Bar @ https://example.com/Foo_Bar-1.0.zip',
+        '/src/My_Project',
+    ]) == sorted([
+        'zope-interface[Foo_Bar]>=4; python_version < "3"',
+        'git+https://github.com/Foo/Bar_Baz.git#egg=Bar_Baz',
+        'https://example.com/Foo_Bar-1.0.tar.gz',
+        'Foo_Bar @ https://example.com/Foo_Bar-1.0.zip',
+        '/src/My_Project',
+    ])
+
+
+def test_venv_pool_evicts_least_recently_used():
+    with TempDir() as pool_dir:
+        pool = VirtualEnvPool(pool_dir, max_size=250)
+
+        for i, key in enumerate(['a', 'b', 'c']):
+            os.mkdir(os.path.join(pool_dir, key))
+            meta_path = os.path.join(pool_dir, key + '.json')
+            with open(meta_path, 'w') as f:
+                json.dump({'size': 100}, f)
+            os.utime(meta_path, (i, i))
+
+        # 'a' is used most recently, but 'c' is the one being kept
+        os.utime(os.path.join(pool_dir, 'a.json'), (10, 10))
+        pool._evict('c')
+
+        assert sorted(os.listdir(pool_dir)) == ['a', 'a.json', 'c', 'c.json']
+
+
+class FakeVirtualEnv(object):
+    pip = 'pip'
+
+    def __init__(self, fail_wheel=False):
+        self.calls = []
+        self.fail_wheel = fail_wheel
+
+    def check_output(self, args):
+        self.calls.append(args[1])
+        if args[1] == 'wheel':
+            self.wheel_args = args
+            if self.fail_wheel:
+                raise subprocess.CalledProcessError(1, args, 'no wheel')
+            wheel_dir = args[args.index('--wheel-dir') + 1]
+            open(os.path.join(wheel_dir, 'foo-1.0-py2-none-any.whl'),
+                 'w').close()
+        return args
+
+    def check_output_async(self, args, finish=None):
+        # runs synchronously, finish is called like CommandTask does
+        try:
+            result, error = self.check_output(args), None
+        except subprocess.CalledProcessError as e:
+            result, error = None, e
+        return FakeTask(finish(result, error) if finish else result)
+
+
+class FakeTask(object):
+    def __init__(self, value):
+        self.value = value
+
+    def result(self):
+        return self.value
+
+
+@pytest.mark.parametrize('use_async', [False, True])
+@pytest.mark.parametrize('offline,fail_wheel,calls,no_index', [
+    (False, False, ['wheel', 'install'], True),
+    (False, True, ['wheel', 'install'], False),
+    (True, False, ['install'], True),
+])
+def test_wheelhouse_install(offline, fail_wheel, calls, no_index, use_async):
+    with TempDir() as path:
+        ve = FakeVirtualEnv(fail_wheel)
+        wh = Wheelhouse(path, offline)
+        if use_async:
+            args = wh.install_async(ve, 'foo').result()
+        else:
+            args = wh.install(ve, 'foo')
+
+        assert ve.calls == calls
+        assert ('--no-index' in args) == no_index
+        assert args[args.index('--find-links') + 1] == path
+        assert os.listdir(path) == (['foo-1.0-py2-none-any.whl']
+                                    if calls[0] == 'wheel' and not fail_wheel
+                                    else [])
+
+
+@pytest.mark.parametrize('pkg,local', [
+    ('tox', False),
+    ('tox>=2.0', False),
+    ('https://example.com/foo-1.0.tar.gz', False),
+    ('/src/project', True),
+    ('./project', True),
+    ('dist/foo-1.0.tar.gz', True),
+    ('foo-1.0-py2-none-any.whl', True),
+    ('Foo-1.0.ZIP', True),
+])
+def test_wheelhouse_is_local(pkg, local, monkeypatch):
+    with TempDir() as cwd:
+        # a directory named like a requirement does not make it local
+        os.mkdir(os.path.join(cwd, 'tox'))
+        monkeypatch.chdir(cwd)
+        assert Wheelhouse.is_local(pkg) == local
+
+
+@pytest.mark.parametrize('offline,calls,no_index', [
+    (False, ['wheel', 'install'], False),
+    (True, ['install'], True),
+])
+def test_wheelhouse_installs_local_packages_directly(offline, calls,
+                                                      no_index):
+    with TempDir() as path, TempDir() as project:
+        ve = FakeVirtualEnv()
+        args = Wheelhouse(path, offline).install(ve, project, 'foo')
+
+        assert ve.calls == calls
+        if not offline:
+            assert project not in ve.wheel_args
+            assert 'foo' in ve.wheel_args
+        assert ('--no-index' in args) == no_index
+        assert args[-2:] == [project, 'foo']
+
+
+def test_output_tail_keeps_end():
+    tail = OutputTail(10)
+    for line in ['first\n', 'second\n', 'third\n']:
+        tail.append(line)
+    assert tail.getvalue() == '[13 bytes of output omitted]\nthird\n'
+
+    tail.append('a very long line\n')
+    assert tail.getvalue() == '[26 bytes of output omitted]\nlong line\n'
+    assert tail.size == 10
+
+
+def test_run_command():
+    result = run_command(['sh', '-c', 'echo out; echo err >&2'])
+    assert result.output == 'out\nerr\n'
+    assert result.returncode == 0
+    assert result.wall_time >= result.cpu_time >= 0
+
+
+def test_run_command_captures_stdout():
+    result = run_command(['sh', '-c', 'echo out; echo err >&2; echo more'],
+                         capture_stdout=True)
+    assert result.stdout == 'out\nmore\n'
+    assert sorted(result.output.splitlines()) == ['err', 'more', 'out']
+
+
+def test_virtualenv_check_output_separates_stderr():
+    with TempDir() as path:
+        ve = VirtualEnv(path)
+        assert ve.check_output(['sh', '-c', 'echo out; echo err >&2']) ==\
+            'out\n'
+
+        with pytest.raises(subprocess.CalledProcessError) as e:
+            ve.check_output(['sh', '-c', 'echo err >&2; exit 1'])
+        assert e.value.output == 'err\n'
+
+
+def test_run_command_failure_keeps_tail():
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        run_command(['sh', '-c', 'seq 1000; exit 3'], tail_size=9)
+
+    assert e.value.returncode == 3
+    assert e.value.output.endswith('omitted]\n999\n1000\n')
+
+
+def test_command_task():
+    task = CommandTask(['sh', '-c', 'echo out; echo err >&2; sleep 0.2'],
+                       capture_stdout=True)
+    assert not task.wait(0)
+    assert not task.done()
+
+    result = task.result()
+    assert task.done()
+    assert result.stdout == 'out\n'
+    assert result.output == 'out\nerr\n'
+    assert result.returncode == 0
+
+
+def test_command_task_failure():
+    task = CommandTask(['sh', '-c', 'seq 1000; exit 3'], tail_size=9)
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        task.result()
+    assert e.value.returncode == 3
+    assert e.value.output.endswith('omitted]\n999\n1000\n')
+
+    # the outcome is kept
+    with pytest.raises(subprocess.CalledProcessError):
+        task.result()
+
+
+def test_command_task_finish():
+    task = CommandTask(['sh', '-c', 'exit 1'],
+                       finish=lambda result, error: error.returncode)
+    assert task.result() == 1
+
+
+def test_virtualenv_check_output_async():
+    with TempDir() as path:
+        task = VirtualEnv(path).check_output_async(
+            ['sh', '-c', 'echo $VIRTUAL_ENV; echo err >&2'])
+        assert task.result() == path + '\n'
+
+
+def test_background_task_sees_context():
+    _context.push({'opts': {'value': 'from context'}})
+    try:
+        task = BackgroundTask(lambda key: opts[key], 'value')
+        assert task.result() == 'from context'
+        assert task.done()
+    finally:
+        _context.pop()
+
+
+def test_background_task_reraises():
+    def fail():
+        raise ValueError('broken')
+
+    task = BackgroundTask(fail)
+    assert task.wait()
+    with pytest.raises(ValueError):
+        task.result()
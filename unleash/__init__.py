@@ -4,7 +4,7 @@ __version__ = '0.7.2.dev1'
 from contextlib import contextmanager
 from functools import partial
 
-from werkzeug.local import LocalStack, LocalProxy
+from .local import LocalStack, LocalProxy
 
 
 def _lookup_context(name):
@@ -29,3 +29,7 @@ info = LocalProxy(partial(_lookup_context, 'info'))
 issues = LocalProxy(partial(_lookup_context, 'issues'))
 commit = LocalProxy(partial(_lookup_context, 'commit'))
 opts = LocalProxy(partial(_lookup_context, 'opts'))
+export_cache = LocalProxy(partial(_lookup_context, 'export_cache'))
+venv_pool = LocalProxy(partial(_lookup_context, 'venv_pool'))
+wheelhouse = LocalProxy(partial(_lookup_context, 'wheelhouse'))
+current_plugin = LocalProxy(partial(_lookup_context, 'current_plugin'))
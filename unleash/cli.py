@@ -1,15 +1,17 @@
 import click
 import logbook
-from logbook.more import ColorizedStderrHandler
 from logbook.handlers import NullHandler
 import os
 
 from .exc import UnleashError
 from .plugin import PluginGraph
-from .boilerplate import Recipe
-from .unleash import Unleash
+from .util import ExportCache, VirtualEnvPool, Wheelhouse, user_cache_dir
 from . import _context, opts
 
+# heavy modules (dulwich, jinja2, ...) are imported by the commands needing
+# them, keeping startup and --help fast. tests/test_cli_imports.py checks
+# that this stays the case.
+
 log = logbook.Logger('cli')
 
 
@@ -24,6 +26,27 @@ def umask_value(s):
     return val
 
 
+SIZE_UNITS = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def size_value(s):
+    if s == 'off':
+        return 0
+    if s == 'unlimited':
+        return None
+
+    factor = SIZE_UNITS.get(s[-1:].lower())
+    if factor is not None:
+        s = s[:-1]
+
+    val = int(s) * (factor or 1)
+
+    if val < 0:
+        raise ValueError('Invalid size')
+
+    return val
+
+
 @click.group()
 @click.option(
     '--batch',
@@ -42,10 +65,64 @@ def umask_value(s):
     help='Path to git repository to use.')
 @click.option('--dry-run', '-n', is_flag=True)
 @click.option('--umask', default='0022', type=umask_value)
+@click.option(
+    '--export-cache-size',
+    default='512M',
+    type=size_value,
+    help='Size limit for exported trees shared between plugins, e.g. 512M '
+    '(default: 512M, "off" to disable, "unlimited" for no limit).')
+@click.option(
+    '--export-hardlinks/--no-export-hardlinks',
+    default=False,
+    help='Give plugins hardlinked instead of copied exports. Faster, but '
+    'only safe if no plugin modifies files in place (default: disabled).')
+@click.option(
+    '--export-max-file-size',
+    default='unlimited',
+    type=size_value,
+    help='Leave files larger than this out of exported trees, e.g. 50M '
+    '(default: unlimited).')
+@click.option(
+    '--object-cache-size',
+    default='64M',
+    type=size_value,
+    help='Memory used to cache git objects read during a run (default: 64M).')
+@click.option(
+    '--venv-pool/--no-venv-pool',
+    default=True,
+    help='Clone virtualenvs from templates kept in the cache directory '
+    'instead of creating each one from scratch (default: enabled).')
+@click.option(
+    '--venv-cache-size',
+    default='1G',
+    type=size_value,
+    help='Size limit for cached virtualenv templates, e.g. 1G (default: 1G, '
+    '"unlimited" for no limit).')
+@click.option(
+    '--wheelhouse',
+    type=click.Path(file_okay=False, resolve_path=True),
+    help='Directory of wheels to install packages from, populated from the '
+    'package index as needed (default: in the cache directory).')
+@click.option(
+    '--offline',
+    is_flag=True,
+    help='Only install packages from the wheelhouse, never from the package '
+    'index.')
+@click.option(
+    '--jobs',
+    '-j',
+    default=1,
+    type=click.IntRange(1),
+    help='Number of plugins to run at the same time, e.g. tests, docs and '
+    'packaging checks while linting a release (default: 1).')
 @click.version_option()
 @click.pass_context
-def cli(ctx, root, loglevel, batch, umask, **kwargs):
-    unleash = ctx.obj
+def cli(ctx, root, loglevel, batch, umask, export_cache_size,
+        export_hardlinks, export_max_file_size, venv_pool, venv_cache_size,
+        wheelhouse, offline, jobs, **kwargs):
+    from logbook.more import ColorizedStderrHandler
+
+    plugins = ctx.obj
     if loglevel is None:
         loglevel = logbook.INFO
 
@@ -61,16 +138,36 @@ def cli(ctx, root, loglevel, batch, umask, **kwargs):
             log.info('umask changed from {:04o} to {:04o}'.format(
                 prev_umask, umask))
 
-    _context.push({'opts': {}})
+    export_cache = ExportCache(export_cache_size, export_hardlinks,
+                               export_max_file_size)
+    ctx.call_on_close(export_cache.close)
+
+    venv_pool = VirtualEnvPool(
+        user_cache_dir('venvs', 'templates') if venv_pool else None,
+        venv_cache_size)
+
+    wheelhouse = Wheelhouse(wheelhouse or user_cache_dir('wheels'), offline)
+
+    _context.push({'opts': {}, 'export_cache': export_cache,
+                   'venv_pool': venv_pool, 'wheelhouse': wheelhouse})
 
     opts['interactive'] = not batch,
     opts['root'] = root
     opts.update(kwargs)
 
-    if ctx.invoked_subcommand != 'boilerplate':
-        unleash._init_repo()
+    plugins.workers = jobs
 
-    log.debug('Plugin order: {}'.format(unleash.plugins.resolve_order()))
+    log.debug('Plugin order: {}'.format(plugins.resolve_order()))
+
+
+def _open_unleash(ctx):
+    from .unleash import Unleash
+
+    unleash = Unleash(ctx.obj)
+    unleash._init_repo()
+    ctx.call_on_close(unleash.close)
+
+    return unleash
 
 
 @cli.command()
@@ -95,10 +192,10 @@ def cli(ctx, root, loglevel, batch, umask, **kwargs):
     help='Lint before releasing (default: enabled).')
 @click.option(
     '--ref', '-r', default='master', help='Branch/Tag/Commit to release.')
-@click.pass_obj
-def release(unleash, ref, **kwargs):
+@click.pass_context
+def release(ctx, ref, **kwargs):
     opts.update(kwargs)
-    unleash.create_release(ref)
+    _open_unleash(ctx).create_release(ref)
 
 
 @cli.command()
@@ -108,16 +205,18 @@ def release(unleash, ref, **kwargs):
     default=None,
     help='Branch/Tag/Commit to publish. By default, use newest '
     'tag by commit date.')
-@click.pass_obj
-def publish(unleash, ref, **kwargs):
+@click.pass_context
+def publish(ctx, ref, **kwargs):
     opts.update(kwargs)
-    unleash.publish(ref)
+    _open_unleash(ctx).publish(ref)
 
 
 @cli.command()
 @click.argument('recipe')
 @click.option('-d', '--destination', default='.', type=click.Path())
 def boilerplate(recipe, destination):
+    from .boilerplate import Recipe
+
     rcp = Recipe(recipe)
 
     rcp.collect_answers()
@@ -128,12 +227,9 @@ def main():
     try:
         with NullHandler().applicationbound():
             plugins = PluginGraph()
-            plugins.collect_plugins()
+            plugins.collect_plugins(cli)
             plugins.notify('setup', cli)
 
-        # instantiate application object
-        unleash = Unleash(plugins)
-
-        cli(obj=unleash)
+        cli(obj=plugins)
     except UnleashError as e:
         log.critical(e)
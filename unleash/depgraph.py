@@ -1,53 +1,141 @@
-import networkx as nx
-from networkx.algorithms.dag import (is_directed_acyclic_graph, ancestors,
-                                     descendants, topological_sort)
+from collections import OrderedDict
 
 
 class DependencyGraph(object):
+    """Directed acyclic graph of objects depending on each other.
+
+    Edges are stored as ordered adjacency sets in both directions. Adding a
+    dependency only searches the part of the graph reachable from the new
+    dependency for a cycle, the topological order is computed once and
+    cached until the graph is modified.
+    """
+
     def __init__(self):
-        self.g = nx.DiGraph()
+        # maps each object to its dependencies and dependants respectively;
+        # OrderedDicts with None values serve as ordered sets
+        self._deps = OrderedDict()
+        self._rdeps = OrderedDict()
+        self._order = None
+
+    def _add_node(self, obj):
+        if obj not in self._deps:
+            self._deps[obj] = OrderedDict()
+            self._rdeps[obj] = OrderedDict()
+            self._order = None
+
+    def _depends_on(self, obj, other):
+        # checks if obj depends on other, directly or indirectly
+        seen = set()
+        stack = [obj]
+
+        while stack:
+            cur = stack.pop()
+            if cur == other:
+                return True
+
+            for dep in self._deps.get(cur, ()):
+                if dep not in seen:
+                    seen.add(dep)
+                    stack.append(dep)
+
+        return False
+
+    def _check_edges(self, obj, depends_on):
+        # a new edge obj -> dep closes a cycle iff dep already depends on obj
+        return not any(self._depends_on(dep, obj) for dep in depends_on)
+
+    def _add_edge(self, obj, depending_on):
+        self._add_node(obj)
+        self._add_node(depending_on)
+
+        self._deps[obj][depending_on] = None
+        self._rdeps[depending_on][obj] = None
+        self._order = None
 
     def add_dependency(self, obj, depending_on):
-        ng = self.g.copy()
-        ng.add_edge(obj, depending_on)
-
-        # check if adding these dependencies would add a cyclic dependency
-        if not is_directed_acyclic_graph(ng):
+        if not self._check_edges(obj, [depending_on]):
             raise ValueError('Adding a dependency of {} on {} introduces a '
                              'dependency cycle!.'.format(obj, depending_on))
 
-        self.g = ng
+        self._add_edge(obj, depending_on)
 
     def add_obj(self, obj, depends_on=[]):
-        self.g.add_node(obj)
-
-        ng = self.g.copy()
-        ng.add_edges_from((obj, d) for d in depends_on)
-
-        # check if adding these dependencies would add a cyclic dependency
-        if not is_directed_acyclic_graph(ng):
+        # check all edges before modifying anything, so a failed insertion
+        # leaves the graph untouched
+        if not self._check_edges(obj, depends_on):
             raise ValueError('Adding {} with dependencies {} introduces a '
                              'dependency cycle!.'.format(obj, depends_on))
 
-        self.g = ng
+        self._add_node(obj)
+        for dep in depends_on:
+            self._add_edge(obj, dep)
 
     def get_dependants(self, obj):
-        return self.g.predecessors(obj)
+        return list(self._rdeps[obj])
 
     def get_dependencies(self, obj):
-        return self.g.successors(obj)
+        return list(self._deps[obj])
 
     def get_full_dependants(self, obj):
-        return ancestors(self.g, obj)
+        return self._reachable(self._rdeps, obj)
 
     def get_full_dependencies(self, obj):
-        return descendants(self.g, obj)
+        return self._reachable(self._deps, obj)
+
+    def _reachable(self, edges, obj):
+        found = set()
+        stack = list(edges[obj])
+
+        while stack:
+            cur = stack.pop()
+            if cur not in found:
+                found.add(cur)
+                stack.extend(edges[cur])
+
+        return found
 
     def remove_obj(self, obj):
-        self.g.remove_node(obj)
+        for dep in self._deps.pop(obj):
+            del self._rdeps[dep][obj]
+        for dependant in self._rdeps.pop(obj):
+            del self._deps[dependant][obj]
+        self._order = None
 
     def remove_dependency(self, obj, depending_on):
-        self.g.remove_edge(obj, depending_on)
+        del self._deps[obj][depending_on]
+        del self._rdeps[depending_on][obj]
+        self._order = None
 
     def resolve_order(self):
-        return topological_sort(self.g, reverse=True)
+        """Returns all objects, each one after all of its dependencies."""
+        if self._order is None:
+            self._order = self._topological_order()
+
+        return list(self._order)
+
+    def _topological_order(self):
+        # iterative depth-first search, appending nodes once all of their
+        # dependencies have been appended
+        order = []
+        done = set()
+
+        for root in self._deps:
+            if root in done:
+                continue
+
+            stack = [(root, iter(self._deps[root]))]
+            done.add(root)
+
+            while stack:
+                node, deps = stack[-1]
+
+                for dep in deps:
+                    if dep not in done:
+                        done.add(dep)
+                        stack.append((dep, iter(self._deps[dep])))
+                        break
+                else:
+                    stack.pop()
+                    order.append(node)
+
+        return order
@@ -1,51 +1,831 @@
 from datetime import datetime
+from collections import OrderedDict, deque
+from fnmatch import fnmatchcase
+import hashlib
+import json
+from multiprocessing.pool import ThreadPool
 import os
+import posixpath
 import re
+import shutil
+import subprocess
 from stat import S_ISLNK, S_ISDIR, S_ISREG, S_IFDIR, S_IRWXU, S_IRWXG, S_IRWXO
+from StringIO import StringIO
+import tarfile
+import tempfile
+import threading
 import time
+import zlib
 
 from dateutil.tz import tzlocal
-from dulwich.errors import NotTreeError
-from dulwich.objects import S_ISGITLINK, Blob, Commit, Tree
+from dulwich.errors import NotBlobError, NotTreeError
+from dulwich.file import GitFile
+from dulwich.index import (build_file_from_blob, index_entry_from_stat,
+                           validate_path)
+from dulwich.objects import (S_ISGITLINK, Blob, Commit, FixedSha, ShaFile,
+                             Tag, Tree, object_class)
 import logbook
 from stuf.collects import ChainMap
+from versio.version import Version
 
 log = logbook.Logger('git')
 HASH_RE = re.compile('^[a-zA-Z0-9]{40}$')
+GITATTRIBUTES = '.gitattributes'
 
 
-def export_tree(lookup, tree, path):
+#: Default number of threads used to write files when exporting trees.
+EXPORT_WORKERS = 8
+
+#: Exports with fewer files are written by the calling thread, as handing
+#: them to worker threads costs more than it saves.
+EXPORT_PARALLEL_MIN_FILES = 32
+
+# thread pools are expensive to start and stop on Python 2, so they are
+# shared by all exports, one per number of workers
+_export_pools = {}
+_export_pools_lock = threading.Lock()
+
+#: Size of the chunks blobs are streamed in.
+BLOB_CHUNK_SIZE = 64 * 1024
+
+
+class PathGlobs(object):
+    """Set of glob patterns matching paths inside a tree.
+
+    Patterns are matched component-wise, using :func:`fnmatch.fnmatchcase`
+    for each ``/``-separated part. A ``**`` component matches any number of
+    directories. A pattern matching a directory selects everything below it.
+
+    :param patterns: Iterable of patterns, e.g. ``['setup.py', 'docs',
+                     '**/*.py']``.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = [tuple(p for p in pattern.split('/') if p)
+                         for pattern in patterns]
+
+    # rules read from the same .gitattributes at different times must
+    # compare equal, see TreeExporter.update
+    def __eq__(self, other):
+        return (isinstance(other, PathGlobs)
+                and self.patterns == other.patterns)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(tuple(self.patterns))
+
+    def matches(self, parts):
+        """Checks if the path given as a tuple of components is selected."""
+        return any(self._match(pattern, parts, False)
+                   for pattern in self.patterns)
+
+    def may_match_below(self, parts):
+        """Checks if any path below the directory given as a tuple of
+        components could be selected."""
+        return any(self._match(pattern, parts, True)
+                   for pattern in self.patterns)
+
+    @classmethod
+    def _match(cls, pattern, parts, below):
+        if not parts:
+            if below:
+                return bool(pattern)
+            return all(p == '**' for p in pattern)
+
+        if not pattern:
+            return False
+
+        if pattern[0] == '**':
+            return (cls._match(pattern[1:], parts, below)
+                    or cls._match(pattern, parts[1:], below))
+
+        return (fnmatchcase(parts[0], pattern[0])
+                and cls._match(pattern[1:], parts[1:], below))
+
+
+def read_attribute_rules(lookup, tree, parts):
+    """Reads the ``export-ignore`` rules of a tree's ``.gitattributes``.
+
+    :param lookup: Function to retrieve objects for SHA1 hashes.
+    :param tree: Tree that may contain a ``.gitattributes`` file.
+    :param parts: Path of the tree, as a tuple of components.
+    :return: A list of ``(parts, pattern, value)`` tuples, value being
+             ``True`` if the attribute is set and ``False`` if it is unset.
+             Patterns containing a slash are returned as
+             :class:`~unleash.git.PathGlobs`, others as strings matched
+             against names.
+    """
+    try:
+        mode, hexsha = tree[GITATTRIBUTES]
+    except KeyError:
+        return []
+
+    if not S_ISREG(mode):
+        return []
+
+    rules = []
+    for line in lookup(hexsha).data.splitlines():
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            continue
+
+        # compiled once here, rules are checked for every exported entry
+        pattern = fields[0]
+        if '/' in pattern:
+            pattern = PathGlobs([pattern])
+
+        for attr in fields[1:]:
+            if attr == 'export-ignore' or attr.startswith('export-ignore='):
+                rules.append((parts, pattern, True))
+            elif attr in ('-export-ignore', '!export-ignore'):
+                rules.append((parts, pattern, False))
+
+    return rules
+
+
+def is_export_ignored(rules, parts):
+    """Checks if a path is marked ``export-ignore``.
+
+    Patterns without a slash match the name of the path at any depth below
+    the directory of their ``.gitattributes`` file, others are matched
+    against the path relative to it. The last matching rule wins.
+
+    :param rules: Rules as returned by
+                  :func:`~unleash.git.read_attribute_rules`, outermost
+                  ``.gitattributes`` first.
+    :param parts: Path to check, as a tuple of components.
+    """
+    ignored = False
+
+    for base, pattern, value in rules:
+        rel = parts[len(base):]
+
+        if isinstance(pattern, PathGlobs):
+            matches = pattern.matches(rel)
+        else:
+            matches = fnmatchcase(rel[-1], pattern)
+
+        if matches:
+            ignored = value
+
+    return ignored
+
+
+class TreeExporter(object):
+    """Exports git trees to the filesystem.
+
+    Exporting happens in two passes: First, the tree is walked and all
+    directories are created. Afterwards, blobs are read and written out by a
+    bounded pool of worker threads. Object lookups are serialized, as the
+    object stores provided by dulwich are not thread-safe; writing files and
+    setting permissions happens concurrently.
+
+    :param lookup: Function to retrieve objects for SHA1 hashes.
+    :param workers: Maximum number of threads writing files. With a value of
+                    ``1``, all files are written by the calling thread.
+    :param paths: If given, a list of glob patterns (see
+                  :class:`~unleash.git.PathGlobs`). Only matching paths are
+                  exported, subtrees that cannot contain any match are
+                  skipped without being read.
+    :param export_ignore: Skip paths that have the ``export-ignore``
+                          attribute set in a ``.gitattributes`` file inside
+                          the tree, like ``git archive`` does. Off by
+                          default, as exports used to run tests or build
+                          packages need the whole tree.
+    :param max_file_size: If given, files larger than this many bytes are
+                          skipped and a warning is logged.
+    :param serialize_lookups: Set to ``False`` if ``lookup`` may be called
+                              from multiple threads at once, e.g. for a
+                              :class:`~unleash.git.GitCatFileStore`.
+    """
+
+    FILE_PERM = S_IRWXU | S_IRWXG | S_IRWXO
+
+    def __init__(self, lookup, workers=None, paths=None, export_ignore=False,
+                 max_file_size=None, serialize_lookups=True):
+        self._lookup = lookup
+        self._lookup_lock = threading.Lock() if serialize_lookups else None
+        self.workers = workers if workers is not None else EXPORT_WORKERS
+        self.paths = PathGlobs(paths) if paths is not None else None
+        self.export_ignore = export_ignore
+        self.max_file_size = max_file_size
+
+    def lookup(self, hexsha):
+        if self._lookup_lock is None:
+            return self._lookup(hexsha)
+
+        with self._lookup_lock:
+            return self._lookup(hexsha)
+
+    def export(self, tree, path):
+        """Exports the given tree object to path.
+
+        :param tree: Tree to export.
+        :param path: Output path.
+        :return: The number of files written.
+        """
+        jobs = []
+        self._create_dirs(tree, path, (), self.paths is None, [], jobs)
+        self._write_files(jobs)
+
+        return len(jobs)
+
+    def update(self, old_tree, new_tree, path):
+        """Updates an existing export of ``old_tree`` at path to ``new_tree``.
+
+        Only entries whose mode or SHA1 changed are written, deleted or have
+        their permissions changed. Subtrees with identical SHA1s are skipped
+        without being read.
+
+        :param old_tree: Tree that has been exported to path before.
+        :param new_tree: Tree to export.
+        :param path: Output path.
+        :return: The number of files written.
+        """
+        jobs = []
+        self._update_dirs(old_tree, new_tree, path, (), self.paths is None,
+                          [], [], jobs)
+        self._write_files(jobs)
+
+        return len(jobs)
+
+    def _entries(self, tree, parts, selected, rules):
+        # yields (name, mode, hexsha, selected) for all entries of tree that
+        # are exported. selected is True for entries exported entirely
+        for name, mode, hexsha in tree.iteritems():
+            entry_parts = parts + (name,)
+
+            if self.export_ignore and is_export_ignored(rules, entry_parts):
+                log.debug('Not exporting {} (export-ignore)'.format(
+                    '/'.join(entry_parts)))
+            elif selected or self.paths.matches(entry_parts):
+                yield name, mode, hexsha, True
+            elif S_ISDIR(mode) and self.paths.may_match_below(entry_parts):
+                yield name, mode, hexsha, False
+
+    def _rules(self, tree, parts, rules):
+        if not self.export_ignore:
+            return rules
+        return rules + read_attribute_rules(self.lookup, tree, parts)
+
+    def _create_dirs(self, tree, path, parts, selected, rules, jobs):
+        rules = self._rules(tree, parts, rules)
+
+        for name, mode, hexsha, entry_selected in self._entries(
+                tree, parts, selected, rules):
+            self._add_entry(name, mode, hexsha, os.path.join(path, name),
+                            parts + (name,), entry_selected, rules, jobs)
+
+    def _update_dirs(self, old_tree, new_tree, path, parts, selected,
+                     old_rules, new_rules, jobs):
+        # identical subtrees can only be skipped if the inherited
+        # .gitattributes did not change either
+        if old_tree.id == new_tree.id and old_rules == new_rules:
+            return
+
+        old_rules = self._rules(old_tree, parts, old_rules)
+        new_rules = self._rules(new_tree, parts, new_rules)
+
+        old_entries = {name: (mode, hexsha) for name, mode, hexsha, _
+                       in self._entries(old_tree, parts, selected, old_rules)}
+
+        for name, mode, hexsha, entry_selected in self._entries(
+                new_tree, parts, selected, new_rules):
+            dest = os.path.join(path, name)
+            entry_parts = parts + (name,)
+            old = old_entries.pop(name, None)
+
+            if old == (mode, hexsha) and old_rules == new_rules:
+                continue
+
+            if old is not None:
+                old_mode, old_hexsha = old
+
+                if S_ISDIR(old_mode) and S_ISDIR(mode):
+                    self._update_dirs(self.lookup(old_hexsha),
+                                      self.lookup(hexsha), dest, entry_parts,
+                                      entry_selected, old_rules, new_rules,
+                                      jobs)
+                    continue
+
+                # only the .gitattributes above this entry changed
+                if old == (mode, hexsha):
+                    continue
+
+                # files are never altered in place, not even their mode, as
+                # they might be hardlinked to other exports
+                self._remove_entry(old_mode, dest)
+
+            self._add_entry(name, mode, hexsha, dest, entry_parts,
+                            entry_selected, new_rules, jobs)
+
+        for name, (mode, hexsha) in old_entries.iteritems():
+            self._remove_entry(mode, os.path.join(path, name))
+
+    def _add_entry(self, name, mode, hexsha, dest, parts, selected, rules,
+                   jobs):
+        if S_ISGITLINK(mode):
+            log.error('Ignored submodule {}; submodules are not yet '
+                      'supported.'.format(name))
+        elif S_ISDIR(mode):
+            os.mkdir(dest)
+            os.chmod(dest, 0o0755)
+            self._create_dirs(self.lookup(hexsha), dest, parts, selected,
+                              rules, jobs)
+        elif S_ISLNK(mode) or S_ISREG(mode):
+            jobs.append((dest, mode, hexsha))
+        else:
+            raise ValueError('Cannot deal with mode of {:o} from {}'
+                             .format(mode, name))
+
+    def _remove_entry(self, mode, dest):
+        if S_ISGITLINK(mode):
+            # submodules are never exported
+            return
+        elif S_ISDIR(mode):
+            shutil.rmtree(dest)
+        elif os.path.lexists(dest):
+            # files may be missing if they exceeded max_file_size
+            os.unlink(dest)
+
+    def _write_files(self, jobs):
+        if self.workers < 2 or len(jobs) < EXPORT_PARALLEL_MIN_FILES:
+            for job in jobs:
+                self._write_file(*job)
+            return
+
+        with _export_pools_lock:
+            pool = _export_pools.get(self.workers)
+            if pool is None:
+                pool = _export_pools[self.workers] = ThreadPool(self.workers)
+
+        pool.map(lambda job: self._write_file(*job), jobs)
+
+    def _write_file(self, dest, mode, hexsha):
+        obj = self.lookup(hexsha)
+
+        if (self.max_file_size is not None and S_ISREG(mode)
+                and obj.raw_length() > self.max_file_size):
+            log.warning('Not exporting {} ({} bytes), it exceeds the maximum '
+                        'file size of {} bytes'.format(
+                            dest, obj.raw_length(), self.max_file_size))
+            return
+
+        if S_ISLNK(mode):
+            os.symlink(obj.data, dest)
+        else:
+            with open(dest, 'wb') as out:
+                for chunk in obj.chunked:
+                    out.write(chunk)
+            os.chmod(dest, mode & self.FILE_PERM)
+
+
+def export_tree(lookup, tree, path, **kwargs):
     """Exports the given tree object to path.
 
     :param lookup: Function to retrieve objects for SHA1 hashes.
     :param tree: Tree to export.
     :param path: Output path.
+    :param kwargs: Export options, see :class:`~unleash.git.TreeExporter`.
     """
-    FILE_PERM = S_IRWXU | S_IRWXG | S_IRWXO
+    return TreeExporter(lookup, **kwargs).export(tree, path)
+
+
+class ChunkReader(object):
+    """File-like object reading from an iterable of strings.
+
+    Only a single chunk is held in memory at any time.
+
+    :param chunks: Iterable of strings.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = ''
+        self._pos = 0
+
+    def read(self, size=-1):
+        parts = []
+
+        while size != 0:
+            if self._pos >= len(self._chunk):
+                try:
+                    self._chunk = next(self._chunks)
+                except StopIteration:
+                    break
+                self._pos = 0
+                continue
+
+            end = len(self._chunk) if size < 0 else self._pos + size
+            part = self._chunk[self._pos:end]
+            self._pos += len(part)
+            parts.append(part)
+
+            if size > 0:
+                size -= len(part)
+
+        return ''.join(parts)
+
+    def close(self):
+        # allows generators to clean up, e.g. close files
+        if hasattr(self._chunks, 'close'):
+            self._chunks.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def iter_blob(store, sha, chunk_size=BLOB_CHUNK_SIZE):
+    """Reads the contents of a blob in chunks.
+
+    Loose objects are decompressed incrementally, stores that can stream
+    blobs themselves (like :class:`~unleash.git.GitCatFileStore`) are asked
+    to do so. Other objects (e.g. packed ones, which dulwich can only read
+    as a whole) are loaded completely.
+
+    :param store: Object store containing the blob.
+    :param sha: The id of the blob.
+    :param chunk_size: Maximum size of the chunks returned.
+    :return: An iterator of strings.
+    """
+    if hasattr(store, 'iter_blob'):
+        return store.iter_blob(sha, chunk_size)
+
+    store_path = getattr(store, 'path', None)
+    if store_path is not None:
+        path = os.path.join(store_path, sha[:2], sha[2:])
+        if os.path.exists(path):
+            return _iter_loose_blob(path, sha, chunk_size)
+
+    obj = store[sha]
+    if not isinstance(obj, Blob):
+        raise NotBlobError(sha)
+    return iter(obj.chunked)
+
+
+def _iter_loose_blob(path, sha, chunk_size):
+    decomp = zlib.decompressobj()
+    header = None
+
+    with open(path, 'rb') as f:
+        buf = ''
+        while True:
+            if not buf:
+                buf = f.read(chunk_size)
+                if not buf:
+                    break
+
+            # limit the output size, compressed data may expand a lot
+            data = decomp.decompress(buf, chunk_size)
+            buf = decomp.unconsumed_tail
+
+            if header is None:
+                header, _, data = data.partition('\0')
+                if not header.startswith('blob '):
+                    raise NotBlobError(sha)
+
+            if data:
+                yield data
+
+        data = decomp.flush()
+        if data:
+            yield data
+
+
+class SpooledBlob(Blob):
+    """Blob whose data is kept in a temporary file instead of in memory.
+
+    Reading the data, e.g. through :attr:`chunked`, reads the file in chunks.
+
+    :param spool: Named temporary file holding the data. It is kept open, and
+                  thus kept on disk, as long as the blob exists.
+    :param size: Size of the data in bytes.
+    :param hexsha: Id of the blob.
+    :param chunk_size: Size of the chunks the data is read in.
+    """
+
+    __slots__ = ('spool', 'size', 'chunk_size')
+
+    def __init__(self, spool, size, hexsha, chunk_size=BLOB_CHUNK_SIZE):
+        super(SpooledBlob, self).__init__()
+        self.spool = spool
+        self.size = size
+        self.chunk_size = chunk_size
+        self._sha = FixedSha(hexsha)
+
+    def _iter_chunks(self):
+        # opened separately, so blobs can be read from multiple threads
+        with open(self.spool.name, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), ''):
+                yield chunk
+
+    def as_raw_chunks(self):
+        return self._iter_chunks()
+
+    def raw_length(self):
+        return self.size
+
+    chunked = property(as_raw_chunks)
+
+    def write_loose(self, store):
+        """Writes the blob to ``store`` as a loose object.
+
+        The data is compressed while it is read, so memory use does not
+        depend on the size of the blob.
+
+        :param store: A :class:`~dulwich.object_store.DiskObjectStore`.
+        """
+        obj_dir = os.path.join(store.path, self.id[:2])
+        obj_path = os.path.join(obj_dir, self.id[2:])
+        if os.path.exists(obj_path):
+            return
+
+        comp = zlib.compressobj()
+        fd, tmp_path = tempfile.mkstemp(dir=store.path, prefix='tmp_obj_')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                out.write(comp.compress(self._header()))
+                for chunk in self._iter_chunks():
+                    out.write(comp.compress(chunk))
+                out.write(comp.flush())
+
+            if not os.path.isdir(obj_dir):
+                os.mkdir(obj_dir)
+            os.chmod(tmp_path, 0o0444)
+            os.rename(tmp_path, obj_path)
+        except:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+
+class BlobWriter(object):
+    """File-like object creating a blob from the data written to it.
+
+    Data is spooled to a temporary file and hashed on :meth:`close`, which
+    creates a :class:`~unleash.git.SpooledBlob` backed by that file. Memory
+    use does not depend on the size of the blob.
+
+    :param on_close: Called with the new blob once it has been created.
+    :param chunk_size: Size of the chunks the spooled data is read in.
+    """
+
+    def __init__(self, on_close=None, chunk_size=BLOB_CHUNK_SIZE):
+        self.on_close = on_close
+        self.chunk_size = chunk_size
+        self.size = 0
+        self.id = None
+
+        self._spool = tempfile.NamedTemporaryFile(prefix='unleash-blob-')
+
+    def write(self, data):
+        self._spool.write(data)
+        self.size += len(data)
+
+    def close(self):
+        """Creates the blob, returns its id."""
+        if self.id is not None:
+            return self.id
+
+        try:
+            self._spool.flush()
+            self._spool.seek(0)
+
+            sha = hashlib.sha1('blob {}\0'.format(self.size))
+            for chunk in iter(lambda: self._spool.read(self.chunk_size), ''):
+                sha.update(chunk)
+        except:
+            self._spool.close()
+            raise
+
+        blob = SpooledBlob(self._spool, self.size, sha.hexdigest(),
+                           self.chunk_size)
+        self.id = blob.id
+
+        if self.on_close is not None:
+            self.on_close(blob)
+
+        return self.id
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._spool.close()
+
+
+def export_archive(lookup, tree, fileobj, prefix='', mtime=0,
+                   compression='gz', extra_files={}):
+    """Writes the given tree object as a tar archive to fileobj.
+
+    The archive is written as a stream, fileobj does not need to be
+    seekable. Blobs are read one at a time, nothing is written to disk.
+    Paths marked ``export-ignore`` in ``.gitattributes`` are left out.
+
+    :param lookup: Function to retrieve objects for SHA1 hashes.
+    :param tree: Tree to export.
+    :param fileobj: File-like object to write to.
+    :param prefix: Prefix for all paths inside the archive, e.g. ``pkg-1.0/``.
+    :param mtime: Modification time for all archive members.
+    :param compression: One of ``gz``, ``bz2`` or ``''`` for no compression.
+    :param extra_files: Dictionary of additional files (relative to prefix)
+                        mapped to their content, e.g. a ``PKG-INFO``.
+    """
+    tar = tarfile.open(fileobj=fileobj, mode='w|' + compression)
+
+    try:
+        if prefix.strip('/'):
+            _add_archive_member(tar, prefix.rstrip('/'), tarfile.DIRTYPE,
+                                0o0755, mtime)
+
+        _archive_tree(lookup, tree, tar, prefix, (), [], mtime)
+
+        for name, data in sorted(extra_files.items()):
+            _add_archive_member(tar, posixpath.join(prefix, name),
+                                tarfile.REGTYPE, 0o0644, mtime, len(data),
+                                StringIO(data))
+    finally:
+        tar.close()
+
+
+def _archive_tree(lookup, tree, tar, path, parts, rules, mtime):
+    rules = rules + read_attribute_rules(lookup, tree, parts)
 
     for name, mode, hexsha in tree.iteritems():
-        dest = os.path.join(path, name)
+        dest = posixpath.join(path, name)
 
-        if S_ISGITLINK(mode):
+        if is_export_ignored(rules, parts + (name,)):
+            continue
+        elif S_ISGITLINK(mode):
             log.error('Ignored submodule {}; submodules are not yet supported.'
                       .format(name))
-            # raise ValueError('Does not support submodules')
         elif S_ISDIR(mode):
-            os.mkdir(dest)
-            os.chmod(dest, 0o0755)
-            export_tree(lookup, lookup(hexsha), dest)
+            _add_archive_member(tar, dest, tarfile.DIRTYPE, 0o0755, mtime)
+            _archive_tree(lookup, lookup(hexsha), tar, dest, parts + (name,),
+                          rules, mtime)
         elif S_ISLNK(mode):
-            os.symlink(lookup(hexsha).data, dest)
+            _add_archive_member(tar, dest, tarfile.SYMTYPE, 0o0777, mtime,
+                                linkname=lookup(hexsha).data)
         elif S_ISREG(mode):
-            with open(dest, 'wb') as out:
-                for chunk in lookup(hexsha).chunked:
-                    out.write(chunk)
-            os.chmod(dest, mode & FILE_PERM)
+            blob = lookup(hexsha)
+            _add_archive_member(tar, dest, tarfile.REGTYPE,
+                                mode & TreeExporter.FILE_PERM, mtime,
+                                blob.raw_length(), ChunkReader(blob.chunked))
         else:
             raise ValueError('Cannot deal with mode of {:o} from {}'.format(
                 mode, name))
 
 
+def _add_archive_member(tar, name, type, mode, mtime, size=0, fileobj=None,
+                        linkname=''):
+    member = tarfile.TarInfo(name)
+    member.type = type
+    member.mode = mode
+    member.mtime = mtime
+    member.size = size
+    member.linkname = linkname
+
+    tar.addfile(member, fileobj)
+
+
+def diff_trees(lookup, old_tree, new_tree, paths=None):
+    """Lists the differences between two trees.
+
+    Subtrees with identical ids on both sides are skipped without being
+    looked up, so the cost depends on the size of the change rather than the
+    size of the trees. Results are generated lazily, directory by directory,
+    in name order.
+
+    :param lookup: Function to retrieve objects for SHA1 hashes.
+    :param old_tree: The old :class:`~dulwich.objects.Tree` or ``None``.
+    :param new_tree: The new :class:`~dulwich.objects.Tree` or ``None``.
+    :param paths: If given, glob patterns (see
+                  :class:`~unleash.git.PathGlobs`) that restrict the diff to
+                  matching paths, e.g. ``['docs']``.
+    :return: An iterator of ``(path, old_entry, new_entry)`` tuples for every
+             file that was added, removed or modified. Entries are ``(mode,
+             sha)`` tuples or ``None``, if the path does not exist on that
+             side.
+    """
+    globs = PathGlobs(paths) if paths is not None else None
+    return _diff_trees(lookup, old_tree, new_tree, (), globs, globs is None)
+
+
+def _diff_trees(lookup, old_tree, new_tree, parts, globs, selected):
+    old_entries = {} if old_tree is None else {
+        name: (mode, sha) for name, mode, sha in old_tree.iteritems()}
+    new_entries = {} if new_tree is None else {
+        name: (mode, sha) for name, mode, sha in new_tree.iteritems()}
+
+    for name in sorted(set(old_entries) | set(new_entries)):
+        old = old_entries.get(name)
+        new = new_entries.get(name)
+
+        if old == new:
+            continue
+
+        child_parts = parts + (name, )
+        child_selected = selected or globs.matches(child_parts)
+
+        old_dir = old is not None and S_ISDIR(old[0])
+        new_dir = new is not None and S_ISDIR(new[0])
+
+        if child_selected:
+            old_file = None if old_dir else old
+            new_file = None if new_dir else new
+
+            if old_file != new_file:
+                yield '/'.join(child_parts), old_file, new_file
+        elif not globs.may_match_below(child_parts):
+            continue
+
+        if old_dir or new_dir:
+            for change in _diff_trees(lookup,
+                                      lookup(old[1]) if old_dir else None,
+                                      lookup(new[1]) if new_dir else None,
+                                      child_parts, globs, child_selected):
+                yield change
+
+
+def update_working_copy(repo, old_tree_id, new_tree_id):
+    """Moves the working copy and index of a repository between two trees.
+
+    Only files that differ between ``old_tree_id`` and ``new_tree_id`` are
+    touched, everything else keeps its contents, mtime and index entry.
+    Directories left empty by removed files are deleted.
+
+    :param repo: A :class:`~dulwich.repo.Repo` with a working copy, currently
+                 checked out at ``old_tree_id``.
+    :return: The number of paths that were changed.
+    """
+    store = repo.object_store
+    index = repo.open_index()
+    root = repo.path
+
+    removed = []
+    written = []
+
+    for path, old, new in diff_trees(store.__getitem__, store[old_tree_id],
+                                     store[new_tree_id]):
+        if new is None:
+            removed.append(path)
+        else:
+            written.append((path, new))
+
+    # removals go first, a directory may be replaced by a file
+    for path in removed:
+        full_path = os.path.join(root, *path.split('/'))
+
+        if path in index:
+            del index[path]
+
+        if os.path.lexists(full_path) and not os.path.isdir(full_path):
+            os.unlink(full_path)
+
+        # remove parent directories that are now empty
+        parent = os.path.dirname(full_path)
+        while parent != root and os.path.isdir(parent)\
+                and not os.listdir(parent):
+            os.rmdir(parent)
+            parent = os.path.dirname(parent)
+
+    for path, (mode, sha) in written:
+        if not validate_path(path):
+            continue
+
+        full_path = os.path.join(root, *path.split('/'))
+
+        if os.path.isdir(full_path) and not os.path.islink(full_path)\
+                and not S_ISGITLINK(mode):
+            # leftovers of a directory that has been replaced by a file
+            shutil.rmtree(full_path)
+
+        dirname = os.path.dirname(full_path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        if S_ISGITLINK(mode):
+            if not os.path.isdir(full_path):
+                os.mkdir(full_path)
+            st = os.lstat(full_path)
+        else:
+            st = build_file_from_blob(store[sha], mode, full_path)
+
+        index[path] = index_entry_from_stat(st, sha, 0)
+
+    index.write()
+
+    return len(removed) + len(written)
+
+
 def get_local_timezone(now=None):
     if now is None:
         now = int(time.time())
@@ -66,6 +846,198 @@ def one_or_many(f):
     return _
 
 
+class RefsSnapshot(object):
+    """Snapshot of all refs of a repository.
+
+    All refs are read once, when first needed, and indexed by every short
+    name they can be referred to with. Resolving a name costs a single
+    dictionary lookup. Refs written through the snapshot are stored in the
+    repository and cause the snapshot to be reloaded on next use.
+
+    :param repo: The repository.
+    """
+
+    SYM_PREFIX = 'ref: '
+
+    # prefixes in order of precedence when resolving short names
+    PREFIXES = ['', 'refs/tags/', 'refs/heads/', 'refs/remotes/', 'refs/']
+
+    def __init__(self, repo):
+        self.repo = repo
+        self._raw = None
+
+    def _load(self):
+        if self._raw is not None:
+            return
+
+        raw = {}
+        for name in self.repo.refs.allkeys():
+            value = self.repo.refs.read_ref(name)
+            if value is not None:
+                raw[name] = value
+
+        index = {}
+        for name in raw:
+            for precedence, prefix in enumerate(self.PREFIXES):
+                if name.startswith(prefix):
+                    index.setdefault(name[len(prefix):], []).append(
+                        (precedence, name))
+
+        self._index = {short: [name for _, name in sorted(names)]
+                       for short, names in index.iteritems()}
+        self._raw = raw
+
+    def invalidate(self):
+        """Discards the snapshot, it will be reloaded on next use."""
+        self._raw = None
+
+    def resolve(self, short_name):
+        """Returns all full ref names matching ``short_name``, in order of
+        precedence."""
+        self._load()
+        return self._index.get(short_name, [])
+
+    def symref_target(self, name):
+        """Returns the target of a symbolic ref or ``None``, if name is not
+        a symbolic ref."""
+        self._load()
+        value = self._raw[name]
+
+        if value.startswith(self.SYM_PREFIX):
+            return value[len(self.SYM_PREFIX):]
+
+    def iteritems(self):
+        """Iterates over all ``(name, sha)`` pairs, symbolic refs resolved."""
+        self._load()
+        for name in self._raw:
+            try:
+                yield name, self[name]
+            except KeyError:
+                continue
+
+    def __contains__(self, name):
+        self._load()
+        return name in self._raw
+
+    def __getitem__(self, name):
+        self._load()
+
+        # follow symbolic refs, like dulwich does
+        for _ in range(5):
+            value = self._raw[name]
+            if not value.startswith(self.SYM_PREFIX):
+                return value
+            name = value[len(self.SYM_PREFIX):]
+
+        raise KeyError(name)
+
+    def __setitem__(self, name, sha):
+        self.repo.refs[name] = sha
+        self.invalidate()
+
+
+class TagIndex(object):
+    """Persistent index of all tags of a repository.
+
+    For every tag, the peeled commit, its commit time and the tag name parsed
+    as a version are stored in ``unleash/tags.json`` inside the git
+    directory. On each use, only tags that were added or moved since the
+    index was written are looked up. Annotated tags are peeled to the commit
+    they point to.
+
+    :param repo: The repository.
+    :param refs: A :class:`~unleash.git.RefsSnapshot` of the repository.
+    """
+
+    FORMAT_VERSION = 1
+    TAG_PREFIX = 'refs/tags/'
+
+    def __init__(self, repo, refs):
+        self.repo = repo
+        self.refs = refs
+        self.path = os.path.join(repo.controldir(), 'unleash', 'tags.json')
+
+        self.tags = {}
+        self.newest_tag = None
+        self._load()
+
+        if self._update():
+            self._save()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return
+
+        if data.get('format') != self.FORMAT_VERSION:
+            return
+
+        self.tags = data['tags']
+        self.newest_tag = data['newest']
+
+    def _save(self):
+        dirname = os.path.dirname(self.path)
+        if not os.path.exists(dirname):
+            os.mkdir(dirname)
+
+        with GitFile(self.path, 'wb') as f:
+            json.dump({'format': self.FORMAT_VERSION,
+                       'tags': self.tags,
+                       'newest': self.newest_tag}, f)
+
+    def _update(self):
+        current = {name: sha for name, sha in self.refs.iteritems()
+                   if name.startswith(self.TAG_PREFIX)}
+        changed = False
+
+        for name in list(self.tags):
+            if name not in current:
+                del self.tags[name]
+                changed = True
+
+        for name, sha in current.iteritems():
+            entry = self.tags.get(name)
+            if entry is not None and entry['sha'] == sha:
+                continue
+
+            log.debug('Indexing tag {}'.format(name))
+            self.tags[name] = self._index_tag(name, sha)
+            changed = True
+
+        if changed or self.newest_tag not in self.tags:
+            candidates = [(entry['time'], name)
+                          for name, entry in self.tags.iteritems()
+                          if entry['commit'] is not None]
+            self.newest_tag = max(candidates)[1] if candidates else None
+            changed = True
+
+        return changed
+
+    def _index_tag(self, name, sha):
+        obj = self.repo[sha]
+        while isinstance(obj, Tag):
+            obj = self.repo[obj.object[1]]
+
+        try:
+            version = str(Version(name[len(self.TAG_PREFIX):]))
+        except TypeError:
+            version = None
+
+        if not isinstance(obj, Commit):
+            return {'sha': sha, 'commit': None, 'time': None,
+                    'version': version}
+
+        return {'sha': sha, 'commit': obj.id, 'time': obj.commit_time,
+                'version': version}
+
+    def newest(self):
+        """Returns the full name of the tag pointing to the most recent
+        commit or ``None``, if there are no tags pointing to commits."""
+        return self.newest_tag
+
+
 class ResolvedRef(object):
     """Resolves a commit-ish/tree-ish to an object.
 
@@ -73,15 +1045,22 @@ class ResolvedRef(object):
     23303549/what-are-commit-ish-and-tree-ish-in-git>`_.
 
     Resolution in this function is much simpler, no ``@{}~:/^ `` are supported.
+
+    :param repo: The repository.
+    :param ref: Name to resolve.
+    :param lookup: Function to retrieve objects for SHA1 hashes.
+    :param refs: A :class:`~unleash.git.RefsSnapshot` to resolve names with.
+                 If not given, a new one is created.
     """
 
-    SYM_PREFIX = 'ref: '
+    SYM_PREFIX = RefsSnapshot.SYM_PREFIX
     TAG_PREFIX = 'refs/tags/'
 
-    def __init__(self, repo, ref, lookup=None):
+    def __init__(self, repo, ref, lookup=None, refs=None):
         self.repo = repo
         self.ref = ref
         self.lookup = lookup or repo.object_store.__getitem__
+        self.refs = refs if refs is not None else RefsSnapshot(repo)
 
         candidates = []
 
@@ -89,32 +1068,9 @@ class ResolvedRef(object):
         if HASH_RE.match(ref) and ref in self.repo.object_store:
             candidates.append((ref, 'object', None))
 
-        full_names = [
-            ref,
-            'refs/tags/{}'.format(ref),
-            'refs/heads/{}'.format(ref),
-            'refs/remotes/{}'.format(ref),
-            'refs/{}'.format(ref),
-        ]
-
-        for name in full_names:
-            try:
-                # FIXME: there seems to be a bug in dulwich here that is
-                # triggered by some (possibly broken?) repositories, causing a
-                # StopIteration to be raised.
-                name in self.repo.refs
-            except StopIteration:
-                pass
-
-            if name in self.repo.refs:
-                # store symbolic ref targets
-                target = self.repo.refs.read_ref(name)
-                if not target.startswith(self.SYM_PREFIX):
-                    target = None
-                else:
-                    target = target[len(self.SYM_PREFIX):]
-
-                candidates.append((name, 'ref', target))
+        for name in self.refs.resolve(ref):
+            # store symbolic ref targets
+            candidates.append((name, 'ref', self.refs.symref_target(name)))
 
         self.candidates = candidates
 
@@ -151,7 +1107,21 @@ class ResolvedRef(object):
         if candidate[1] == 'object':
             return candidate[0]
 
-        return self.repo.refs[candidate[0]]
+        return self.refs[candidate[0]]
+
+    @property
+    @one_or_many
+    def peeled_id(self, candidate):
+        """Like :attr:`id`, but annotated tags are followed to the object
+        they point to."""
+        sha = candidate[0] if candidate[1] == 'object' else\
+            self.refs[candidate[0]]
+
+        obj = self.lookup(sha)
+        while isinstance(obj, Tag):
+            obj = self.lookup(obj.object[1])
+
+        return obj.id
 
     @property
     def found(self):
@@ -179,7 +1149,220 @@ class ResolvedRef(object):
         return self.repo[candidate[0]]
 
 
+class ObjectCache(object):
+    """Byte-bounded LRU cache of parsed git objects.
+
+    Can be used in place of an object store for lookups. Objects handed out
+    are shared and must not be modified. The cache is thread-safe; reads from
+    stores that are not (like dulwich's) are serialized.
+
+    :param store: Object store to read objects from.
+    :param max_size: Maximum total raw size of all cached objects in bytes.
+                     ``None`` means unlimited.
+    """
+
+    thread_safe = True
+
+    def __init__(self, store, max_size=64 * 1024 * 1024):
+        self.store = store
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._objects = OrderedDict()
+        self._lock = threading.Lock()
+        self._store_lock = (None if getattr(store, 'thread_safe', False)
+                            else threading.Lock())
+
+    def __getitem__(self, sha):
+        with self._lock:
+            obj = self._objects.pop(sha, None)
+
+            if obj is not None:
+                self.hits += 1
+                self._objects[sha] = obj
+                return obj
+
+            self.misses += 1
+
+        obj = self._from_store(self.store.__getitem__, sha)
+        size = obj.raw_length()
+
+        with self._lock:
+            if ((self.max_size is None or size <= self.max_size)
+                    and sha not in self._objects):
+                self._objects[sha] = obj
+                self.size += size
+
+                while (self.max_size is not None
+                       and self.size > self.max_size):
+                    _, evicted = self._objects.popitem(last=False)
+                    self.size -= evicted.raw_length()
+
+        return obj
+
+    def __contains__(self, sha):
+        with self._lock:
+            if sha in self._objects:
+                return True
+
+        return self._from_store(self.store.__contains__, sha)
+
+    def iter_blob(self, sha, chunk_size=BLOB_CHUNK_SIZE):
+        # blobs that are streamed are not added to the cache
+        with self._lock:
+            obj = self._objects.get(sha)
+
+        if obj is not None:
+            return iter(obj.chunked)
+
+        # only reads packed objects right away, loose ones are streamed
+        return self._from_store(iter_blob, self.store, sha, chunk_size)
+
+    def _from_store(self, func, *args):
+        if self._store_lock is None:
+            return func(*args)
+
+        with self._store_lock:
+            return func(*args)
+
+    def __str__(self):
+        return '{}({} objects, {} bytes, {} hits, {} misses)'.format(
+            self.__class__.__name__, len(self._objects), self.size,
+            self.hits, self.misses)
+
+
+class _CatFileRequest(object):
+    __slots__ = ('sha', 'done', 'obj', 'error')
+
+    def __init__(self, sha):
+        self.sha = sha
+        self.done = False
+        self.obj = None
+        self.error = None
+
+
+class GitCatFileStore(object):
+    """Reads objects through a long-running ``git cat-file --batch`` process.
+
+    Avoids dulwich's pure-python pack access, which is slow on large
+    packfiles. The store is safe to use from multiple threads: requests are
+    written to git as soon as they are made, so concurrent lookups are
+    pipelined. Whichever thread is reading hands out the answers in order.
+
+    Only reading is supported, new objects must be added through the
+    repository's object store.
+
+    :param repo: The :class:`~dulwich.repo.Repo` to read from.
+    :param git_binary: The git executable to run.
+    """
+
+    thread_safe = True
+
+    def __init__(self, repo, git_binary='git'):
+        self.repo = repo
+        self.git_binary = git_binary
+        self.proc = subprocess.Popen(
+            [git_binary, '--git-dir', repo.controldir(), 'cat-file',
+             '--batch'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, )
+
+        self._pending = deque()
+        self._write_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+
+    def __getitem__(self, sha):
+        req = _CatFileRequest(sha)
+
+        with self._write_lock:
+            # queue before writing, so answers are matched up in order
+            self._pending.append(req)
+            try:
+                self.proc.stdin.write(sha + '\n')
+                self.proc.stdin.flush()
+            except (IOError, ValueError):
+                self._pending.pop()
+                raise IOError('git cat-file is not running')
+
+        with self._read_lock:
+            while not req.done:
+                self._read_response()
+
+        if req.error is not None:
+            raise req.error
+        return req.obj
+
+    def __contains__(self, sha):
+        return sha in self.repo.object_store
+
+    def iter_blob(self, sha, chunk_size=BLOB_CHUNK_SIZE):
+        # the batch process would be blocked while streaming, use a separate
+        # one instead
+        if sha not in self:
+            raise KeyError(sha)
+        return self._iter_blob(sha, chunk_size)
+
+    def _iter_blob(self, sha, chunk_size):
+        proc = subprocess.Popen(
+            [self.git_binary, '--git-dir', self.repo.controldir(),
+             'cat-file', 'blob', sha],
+            stdout=subprocess.PIPE, )
+
+        try:
+            for chunk in iter(lambda: proc.stdout.read(chunk_size), ''):
+                yield chunk
+        finally:
+            proc.stdout.close()
+            if proc.wait() not in (0, -13):  # SIGPIPE, if closed early
+                raise NotBlobError(sha)
+
+    def close(self):
+        """Stops the git process."""
+        with self._write_lock:
+            if not self.proc.stdin.closed:
+                self.proc.stdin.close()
+        self.proc.wait()
+
+    def _read_response(self):
+        req = self._pending.popleft()
+        header = self.proc.stdout.readline()
+
+        if not header:
+            req.error = IOError('git cat-file exited')
+        else:
+            fields = header.split()
+
+            if len(fields) != 3:
+                # "<sha> missing" (or ambiguous)
+                req.error = KeyError(req.sha)
+            else:
+                data = self.proc.stdout.read(int(fields[2]))
+                self.proc.stdout.read(1)  # trailing newline
+
+                req.obj = ShaFile.from_raw_string(
+                    object_class(fields[1]).type_num, data, fields[0])
+
+        req.done = True
+
+
+class _TreeEdit(object):
+    # staged edits of a single tree, mapping names to either (mode, id)
+    # tuples or _TreeEdit instances for subtrees. if replace is set, the
+    # existing contents are discarded.
+    __slots__ = ('entries', 'replace')
+
+    def __init__(self, replace=False):
+        self.entries = {}
+        self.replace = replace
+
+
 class MalleableCommit(object):
+    # number of new objects from which on save() writes a pack instead of
+    # loose objects
+    PACK_THRESHOLD = 32
+
     def __init__(self,
                  repo,
                  author=u'',
@@ -191,7 +1374,8 @@ class MalleableCommit(object):
                  author_time=None,
                  commit_timezone=None,
                  author_timezone=None,
-                 encoding='UTF-8'):
+                 encoding='UTF-8',
+                 objects=None):
         now = int(time.time())
         local_timezone = get_local_timezone(now)
 
@@ -213,12 +1397,18 @@ class MalleableCommit(object):
         self.author_timezone = (author_timezone if author_timezone is not None
                                 else local_timezone)
 
+        # guards staged edits and the path index, plugins may use the commit
+        # from multiple threads
+        self._lock = threading.RLock()
         self.tree = tree
 
         self.new_objects = {}
 
-        # chain used for looking up items, may include uncommitted ones
-        self._lookup_chain = ChainMap(self.new_objects, self.repo.object_store)
+        # chain used for looking up items, may include uncommitted ones.
+        # reads go through objects, if given, e.g. an ObjectCache
+        self._objects = (objects if objects is not None
+                         else self.repo.object_store)
+        self._lookup_chain = ChainMap(self.new_objects, self._objects)
 
     @classmethod
     def from_parent(cls, repo, parent_id):
@@ -230,10 +1420,11 @@ class MalleableCommit(object):
         return nc
 
     @classmethod
-    def from_existing(cls, repo, commit_id):
+    def from_existing(cls, repo, commit_id, objects=None):
         commit = repo[commit_id]
         encoding = commit.encoding or 'UTF-8'
         return cls(repo,
+                   objects=objects,
                    author=commit.author,
                    message=commit.message.decode(encoding),
                    parent_ids=commit.parents,
@@ -274,53 +1465,150 @@ class MalleableCommit(object):
         return self.set_path_id(path, blob.id, mode)
 
     def set_path_id(self, path, id, mode=0o0100644):
+        # edits are only recorded here, trees are rebuilt and hashed once
+        # the tree is accessed the next time.
         # we use regular "/" split here, as dulwich uses the same method
         parts = path.split('/')
 
-        self.tree = self._path_add(self.tree, parts, id, mode)
-        self.new_objects[self.tree.id] = self.tree
+        with self._lock:
+            if self._pending is None:
+                self._pending = _TreeEdit()
 
-    def _path_add(self, tree, parts, id, mode):
-        if len(parts) == 1:
-            fn = parts[0]
+            node = self._pending
+            for name in parts[:-1]:
+                child = node.entries.get(name)
 
-            # add id and remember altered tree
-            tree.add(fn, mode, id)
-            return tree
+                if not isinstance(child, _TreeEdit):
+                    # a file staged at this path is replaced by a directory
+                    child = _TreeEdit(replace=child is not None)
+                    node.entries[name] = child
 
-        # there are more parts left
-        subtree_name = parts[0]
+                node = child
+
+            node.entries[parts[-1]] = (mode, id)
+
+            self._invalidate_path(tuple(p for p in parts if p), (mode, id))
+
+    @property
+    def tree(self):
+        with self._lock:
+            if self._pending is not None:
+                pending, self._pending = self._pending, None
+
+                tree = self._apply_edit(self._tree, pending)
+                if self._tree is None or tree.id != self._tree.id:
+                    self.new_objects[tree.id] = tree
+                self._tree = tree
+
+            return self._tree
+
+    @tree.setter
+    def tree(self, tree):
+        self._tree = tree
+        self._pending = None
+
+        # path index: maps path tuples to (mode, sha), filled one directory
+        # at a time. _indexed_dirs holds directories whose entries are all
+        # present, _index_children the indexed names below each path
+        self._path_index = {}
+        self._indexed_dirs = set()
+        self._index_children = {}
+
+    def _apply_edit(self, tree, edit):
+        if tree is None or edit.replace:
+            new_tree = Tree()
+        else:
+            new_tree = tree.copy()
+
+        for name, entry in edit.entries.iteritems():
+            if not isinstance(entry, _TreeEdit):
+                new_tree.add(name, entry[0], entry[1])
+                continue
 
-        try:
-            subtree_mode, subtree_id = tree[subtree_name]
-            if not S_ISDIR(subtree_mode):
-                subtree = None  # if it's a regular file, we overwrite it
-            else:
-                subtree = self._lookup_chain[subtree_id]
-        except KeyError:
             subtree = None
-            subtree_mode = S_IFDIR
+            subtree_id = None
+
+            if not entry.replace and name in new_tree:
+                subtree_mode, subtree_id = new_tree[name]
+
+                # if it's a regular file, we overwrite it
+                if S_ISDIR(subtree_mode):
+                    subtree = self._lookup_chain[subtree_id]
 
-        if subtree is None:
-            subtree = Tree()
+            subtree = self._apply_edit(subtree, entry)
 
-        # alter subtree and add to our tree
-        old_subtree_id = subtree.id
-        subtree = self._path_add(subtree, parts[1:], id, mode)
+            # only store if the subtree actually changed
+            if subtree.id != subtree_id:
+                self.new_objects[subtree.id] = subtree
+                new_tree.add(name, S_IFDIR, subtree.id)
 
-        # only store if the subtree actually changed
-        if subtree.id != old_subtree_id:
-            self.new_objects[subtree.id] = subtree
-            tree.add(subtree_name, subtree_mode, subtree.id)
+        return new_tree
 
-        return tree
+    def has_object(self, hexsha):
+        """Checks whether an object can be looked up through this commit,
+        either in the repository or among the objects not yet saved."""
+        return hexsha in self._lookup_chain
 
-    def export_to(self, path):
-        export_tree(self._lookup_chain.__getitem__, self.tree, path)
+    def export_to(self, path, base_tree_id=None, **kwargs):
+        """Exports the tree of this commit to path.
+
+        :param path: Output path.
+        :param base_tree_id: If given, path must contain an export of the
+                             tree with this id, which is updated in place
+                             instead of exporting the whole tree. The previous
+                             export must have used the same options.
+        :param kwargs: Export options, see :class:`~unleash.git.TreeExporter`.
+        """
+        kwargs.setdefault('serialize_lookups',
+                          not getattr(self._objects, 'thread_safe', False))
+        exporter = TreeExporter(self._lookup_chain.__getitem__, **kwargs)
+
+        if base_tree_id is None:
+            exporter.export(self.tree, path)
+        else:
+            exporter.update(self._lookup_chain[base_tree_id], self.tree, path)
+
+    def export_archive(self, fileobj, prefix='', compression='gz',
+                       extra_files={}):
+        """Streams the tree of this commit into a tar archive.
+
+        All members are timestamped with the commit time. See
+        :func:`~unleash.git.export_archive` for a description of the
+        arguments.
+        """
+        export_archive(self._lookup_chain.__getitem__, self.tree, fileobj,
+                       prefix, self.commit_time, compression, extra_files)
+
+    def diff(self, base, paths=None):
+        """Lists the files that differ between ``base`` and this commit.
+
+        :param base: Id of a commit, tree or annotated tag to compare
+                     against. If ``None``, every file is reported as added.
+        :param paths: Optional glob patterns to restrict the diff to.
+        :return: An iterator of ``(path, old_entry, new_entry)`` tuples, see
+                 :func:`~unleash.git.diff_trees`.
+        """
+        base_tree = None
+        if base is not None:
+            base_tree = self._lookup_chain[base]
+            while isinstance(base_tree, Tag):
+                base_tree = self._lookup_chain[base_tree.object[1]]
+            if isinstance(base_tree, Commit):
+                base_tree = self._lookup_chain[base_tree.tree]
+
+        return diff_trees(self._lookup_chain.__getitem__, base_tree,
+                          self.tree, paths)
+
+    def has_changes(self, base, paths=None):
+        """Checks if any file (below ``paths``, if given) differs between
+        ``base`` and this commit. Stops at the first difference found."""
+        for change in self.diff(base, paths):
+            return True
+        return False
 
     def path_exists(self, path):
         try:
-            self.get_path_data(path)
+            self._lookup(path)
             return True
         except (KeyError, NotTreeError):
             return False
@@ -337,7 +1625,52 @@ class MalleableCommit(object):
     def get_path_mode(self, path):
         return self._lookup(path)[0]
 
-    def save(self):
+    def open_path(self, path, chunk_size=BLOB_CHUNK_SIZE):
+        """Opens a file of this commit for reading.
+
+        Unlike :meth:`get_path_data`, the contents are streamed where
+        possible (see :func:`~unleash.git.iter_blob`).
+
+        :return: A file-like object supporting ``read()``.
+        """
+        sha = self.get_path_id(path)
+
+        obj = self.new_objects.get(sha)
+        if obj is not None:
+            if not isinstance(obj, Blob):
+                raise NotBlobError(sha)
+            return ChunkReader(obj.chunked)
+
+        return ChunkReader(iter_blob(self._objects, sha, chunk_size))
+
+    def open_path_writer(self, path, mode=0o0100644):
+        """Opens a file of this commit for writing.
+
+        The data is kept in a temporary file until the commit is saved and
+        path is set to it once the writer is closed; memory use does not
+        depend on the size of the file::
+
+            with commit.open_path_writer('data.bin') as f:
+                f.write(...)
+
+        :return: A :class:`~unleash.git.BlobWriter`.
+        """
+        def on_close(blob):
+            with self._lock:
+                self.new_objects[blob.id] = blob
+            self.set_path_id(path, blob.id, mode)
+
+        return BlobWriter(on_close)
+
+    def save(self, pack=None):
+        """Stores the commit and all new objects reachable from it.
+
+        :param pack: If ``True``, all objects are written as a single pack,
+                     if ``False``, as loose objects. By default, a pack is
+                     written if there are at least ``PACK_THRESHOLD``
+                     objects.
+        :return: The id of the new commit.
+        """
         # generate the commit
         commit = self.to_commit()
         self.new_objects[commit.id] = commit
@@ -363,11 +1696,86 @@ class MalleableCommit(object):
                     q.append(sha)
 
         # add all collected objects
-        for id in ids_to_add:
-            self.repo.object_store.add_object(self.new_objects[id])
+        objects = [self.new_objects[id] for id in ids_to_add]
+
+        # spooled blobs are streamed into loose objects, packing them would
+        # read them into memory
+        store = self.repo.object_store
+        if getattr(store, 'path', None) is not None:
+            for obj in objects:
+                if isinstance(obj, SpooledBlob):
+                    obj.write_loose(store)
+            objects = [obj for obj in objects
+                       if not isinstance(obj, SpooledBlob)]
+
+        if pack is None:
+            pack = len(objects) >= self.PACK_THRESHOLD
+
+        if pack:
+            log.debug('Writing {} objects as pack'.format(len(objects)))
+            store.add_objects([(obj, None) for obj in objects])
+        else:
+            for obj in objects:
+                store.add_object(obj)
 
         return commit.id
 
     def _lookup(self, path):
-        # construct a lookup chain that
-        return self.tree.lookup_path(self._lookup_chain.__getitem__, path)
+        # like Tree.lookup_path, empty components are skipped
+        parts = tuple(p for p in path.split('/') if p)
+
+        try:
+            with self._lock:
+                return self._lookup_parts(parts)
+        except KeyError:
+            raise KeyError(path)
+
+    def _lookup_parts(self, parts):
+        if not parts:
+            return S_IFDIR, self.tree.id
+
+        entry = self._path_index.get(parts)
+        if entry is not None:
+            return entry
+
+        dir_parts = parts[:-1]
+        if dir_parts not in self._indexed_dirs:
+            mode, sha = self._lookup_parts(dir_parts)
+            if not S_ISDIR(mode):
+                raise NotTreeError(sha)
+            self._index_dir(dir_parts, self._lookup_chain[sha])
+
+        # the directory is fully indexed, a miss means there is no such entry
+        return self._path_index[parts]
+
+    def _index_dir(self, dir_parts, tree):
+        children = self._index_children.setdefault(dir_parts, set())
+
+        for name, mode, sha in tree.iteritems():
+            self._path_index[dir_parts + (name, )] = (mode, sha)
+            children.add(name)
+
+        self._indexed_dirs.add(dir_parts)
+
+    def _invalidate_path(self, parts, entry):
+        # the ids of all parent trees change, their other entries stay valid
+        for i in range(len(parts)):
+            self._indexed_dirs.discard(parts[:i])
+            self._path_index.pop(parts[:i], None)
+
+        # anything previously found below the path is gone
+        stack = [parts]
+        while stack:
+            cur = stack.pop()
+            self._indexed_dirs.discard(cur)
+            for name in self._index_children.pop(cur, ()):
+                child = cur + (name, )
+                self._path_index.pop(child, None)
+                stack.append(child)
+
+        self._path_index[parts] = entry
+
+        # link every ancestor to its child, so that replacing any of them
+        # later invalidates this entry as well
+        for i in range(len(parts)):
+            self._index_children.setdefault(parts[:i], set()).add(parts[i])
@@ -0,0 +1,98 @@
+"""Thread-local context stack and proxies.
+
+A small subset of :mod:`werkzeug.local`, which takes longer to import than
+the rest of the command-line interface, as it pulls in most of werkzeug.
+"""
+
+import operator
+import threading
+
+
+class LocalStack(object):
+    """Stack of objects, separate for every thread."""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def push(self, obj):
+        self._local.__dict__.setdefault('stack', []).append(obj)
+
+    def pop(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack:
+            return stack.pop()
+
+    @property
+    def top(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack:
+            return stack[-1]
+
+
+class LocalProxy(object):
+    """Forwards all operations to the object returned by calling ``lookup``.
+
+    :param lookup: Function returning the current object.
+    """
+
+    __slots__ = ('_lookup', )
+
+    def __init__(self, lookup):
+        object.__setattr__(self, '_lookup', lookup)
+
+    def _get_current_object(self):
+        return self._lookup()
+
+    def __getattr__(self, name):
+        return getattr(self._lookup(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._lookup(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._lookup(), name)
+
+    def __dir__(self):
+        return dir(self._lookup())
+
+    def __call__(self, *args, **kwargs):
+        return self._lookup()(*args, **kwargs)
+
+    def __repr__(self):
+        try:
+            obj = self._lookup()
+        except RuntimeError:
+            return '<{} unbound>'.format(self.__class__.__name__)
+        return repr(obj)
+
+
+def _forward(name, func):
+    def method(self, *args):
+        return func(self._lookup(), *args)
+
+    method.__name__ = name
+    return method
+
+
+# special methods are looked up on the type, so __getattr__ does not cover
+# them
+for _name, _func in [
+        ('__str__', str),
+        ('__unicode__', unicode),
+        ('__nonzero__', bool),
+        ('__len__', len),
+        ('__iter__', iter),
+        ('__hash__', hash),
+        ('__contains__', lambda obj, item: item in obj),
+        ('__getitem__', operator.getitem),
+        ('__setitem__', operator.setitem),
+        ('__delitem__', operator.delitem),
+        ('__eq__', operator.eq),
+        ('__ne__', operator.ne),
+        ('__lt__', operator.lt),
+        ('__le__', operator.le),
+        ('__gt__', operator.gt),
+        ('__ge__', operator.ge), ]:
+    setattr(LocalProxy, _name, _forward(_name, _func))
+
+del _name, _func
@@ -1,15 +1,160 @@
+from functools import partial
+import json
 import os
+from Queue import Empty, Queue
+import sys
+import tempfile
+import threading
 
+import click
 from pluginbase import PluginBase
 from logbook import Logger
 
-from . import plugins
+from . import __version__, plugins, new_local_stack, _context
 from .depgraph import DependencyGraph
 from .exc import InvocationError
+from .util import user_cache_dir
 
 plugin_base = PluginBase(package='unleash.plugins')
 log = Logger('plugins')
 
+#: Functions a plugin may define, called by :meth:`PluginGraph.notify`.
+HOOKS = ['setup', 'collect_info', 'prepare_release', 'lint_release',
+         'prepare_dev', 'publish_release']
+
+MANIFEST_FORMAT = 1
+
+# builtin click types, which can be stored in the manifest by name
+_OPTION_TYPES = ['STRING', 'INT', 'FLOAT', 'BOOL', 'UNPROCESSED']
+
+# Option attributes derived from the parameter declarations or not storable
+_OPTION_SKIP = ['opts', 'secondary_opts', 'name', 'type', 'is_bool_flag']
+
+
+def _dump_option(option):
+    # returns a json-serializable description of a click Option, or None if
+    # it cannot be recreated exactly
+    type_name = next((name for name in _OPTION_TYPES
+                      if option.type is getattr(click, name)), None)
+    if type_name is None:
+        return None
+
+    decls = option.opts[:]
+    if option.secondary_opts:
+        if len(option.secondary_opts) != len(option.opts):
+            return None
+        decls = ['{}/{}'.format(*pair)
+                 for pair in zip(option.opts, option.secondary_opts)]
+
+    attrs = {k: v for k, v in vars(option).iteritems()
+             if k not in _OPTION_SKIP}
+
+    # the type is usually inferred, passing it explicitly changes how flags
+    # are set up. only store it if necessary
+    for type_ in [None, type_name]:
+        data = {'decls': decls + [option.name], 'type': type_,
+                'attrs': attrs}
+
+        # verify the option survives a round trip
+        try:
+            copy = _load_option(json.loads(json.dumps(data)))
+        except (TypeError, ValueError):
+            continue
+
+        if vars(copy) == vars(option):
+            return data
+
+
+def _load_option(data):
+    kwargs = {str(k): v for k, v in data['attrs'].iteritems()}
+    if data['type'] is not None:
+        kwargs['type'] = getattr(click, data['type'])
+    return click.Option(data['decls'], **kwargs)
+
+
+class _OptionRecorder(object):
+    # stands in for the cli when recording the options added by setup()
+    def __init__(self, cli):
+        self.options = []
+        self.params = _RecordingList(self.options, None)
+        self.commands = {name: _CommandRecorder(self.options, name)
+                         for name in cli.commands}
+
+
+class _CommandRecorder(object):
+    def __init__(self, options, name):
+        self.params = _RecordingList(options, name)
+
+
+class _RecordingList(list):
+    def __init__(self, options, command):
+        super(_RecordingList, self).__init__()
+        self._options = options
+        self._command = command
+
+    def append(self, option):
+        self._options.append((self._command, option))
+
+
+class LazyPlugin(object):
+    """Stands in for a plugin module described by a manifest entry.
+
+    The module is only imported once one of its hooks is called or an
+    attribute not contained in the manifest is accessed. The ``setup`` hook
+    adds the recorded command-line options without importing the module.
+
+    :param source: The plugin source to load the module from.
+    :param entry: The plugin's entry in the manifest.
+    """
+
+    def __init__(self, source, entry):
+        self._source = source
+        self._entry = entry
+        self._module = None
+        self._lock = threading.Lock()
+
+        self.PLUGIN_NAME = entry['name']
+        self.PLUGIN_DEPENDS = entry['depends']
+
+        if entry['export_paths'] is not None:
+            self.PLUGIN_EXPORT_PATHS = entry['export_paths']
+
+    def load(self):
+        """Imports the plugin module, if not done already, and returns it."""
+        with self._lock:
+            if self._module is None:
+                log.debug('Loading plugin {}'.format(self.PLUGIN_NAME))
+                self._module = self._source.load_plugin(
+                    self._entry['module'])
+
+            return self._module
+
+    def setup(self, cli):
+        options = self._entry['options']
+
+        if options is None:
+            # some options could not be recorded
+            return self.load().setup(cli)
+
+        for command, data in options:
+            params = (cli.params if command is None
+                      else cli.commands[command].params)
+            params.append(_load_option(data))
+
+    def _call(self, name, *args, **kwargs):
+        return getattr(self.load(), name)(*args, **kwargs)
+
+    def __getattr__(self, name):
+        if name in HOOKS:
+            if name not in self._entry['hooks']:
+                raise AttributeError(name)
+            return partial(self._call, name)
+
+        return getattr(self.load(), name)
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__, self.PLUGIN_NAME)
+
 
 class PluginGraph(DependencyGraph):
     NAME_ATTR = 'PLUGIN_NAME'
@@ -19,49 +164,259 @@ class PluginGraph(DependencyGraph):
         super(PluginGraph, self).__init__(*args, **kwargs)
         self.plugin_mods = {}
 
+        #: Maximum number of hooks run at the same time by :meth:`notify`.
+        self.workers = 1
+
     def add_plugin(self, plugin):
         name = getattr(plugin, self.NAME_ATTR)
         self.plugin_mods[name] = plugin
 
         self.add_obj(name, depends_on=getattr(plugin, self.DEP_ATTR, []))
 
-    def collect_plugins(self):
-        # discover and load plugins
+    def collect_plugins(self, cli=None, manifest_path=None):
+        """Discovers plugins.
+
+        Instead of importing all plugin modules, a manifest describing them
+        is read from ``manifest_path`` and the plugins are added as
+        :class:`~unleash.plugin.LazyPlugin` instances. If the manifest is
+        missing or any plugin file changed, all plugins are imported and the
+        manifest is rebuilt.
+
+        :param cli: The click group the plugins' options will be added to.
+                    Required to record the options in the manifest; if not
+                    given, no manifest is used.
+        :param manifest_path: Where to store the manifest. Defaults to
+                              ``plugins.json`` in the cache directory.
+        """
+        searchpath = os.path.dirname(plugins.__file__)
         plugin_source = plugin_base.make_plugin_source(
             persist=True,
-            searchpath=[os.path.dirname(plugins.__file__)]
+            searchpath=[searchpath]
         )
 
+        if cli is None:
+            with plugin_source:
+                for module_name in plugin_source.list_plugins():
+                    pl = plugin_source.load_plugin(module_name)
+
+                    # skip modules without ``PLUGIN_NAME`` attribute
+                    if hasattr(pl, self.NAME_ATTR):
+                        self.add_plugin(pl)
+            return
+
+        if manifest_path is None:
+            manifest_path = user_cache_dir('plugins.json')
+
+        key = self._manifest_key(searchpath)
+        manifest = self._read_manifest(manifest_path)
+
+        if manifest is None or manifest['key'] != key:
+            log.debug('Rebuilding plugin manifest {}'.format(manifest_path))
+            manifest = self._build_manifest(plugin_source, cli, key)
+            self._write_manifest(manifest_path, manifest)
+
+        for entry in manifest['plugins']:
+            self.add_plugin(LazyPlugin(plugin_source, entry))
+
+    def _manifest_key(self, searchpath):
+        # changes whenever a plugin file (or unleash itself) is changed
+        files = []
+        for name in sorted(os.listdir(searchpath)):
+            if name.endswith(('.pyc', '.pyo')) or name == '__pycache__':
+                continue
+            st = os.stat(os.path.join(searchpath, name))
+            files.append([name, st.st_mtime, st.st_size])
+
+        return {'format': MANIFEST_FORMAT, 'version': __version__,
+                'path': searchpath, 'files': files}
+
+    def _build_manifest(self, plugin_source, cli, key):
+        entries = []
+
         with plugin_source:
-            for plugin_name in plugin_source.list_plugins():
-                pl = plugin_source.load_plugin(plugin_name)
+            for module_name in plugin_source.list_plugins():
+                pl = plugin_source.load_plugin(module_name)
 
-                # skip modules without ``PLUGIN_NAME`` attribute
                 if not hasattr(pl, self.NAME_ATTR):
                     continue
 
-                self.add_plugin(pl)
+                entries.append({
+                    'module': module_name,
+                    'name': getattr(pl, self.NAME_ATTR),
+                    'depends': list(getattr(pl, self.DEP_ATTR, [])),
+                    'export_paths': getattr(pl, 'PLUGIN_EXPORT_PATHS', None),
+                    'hooks': [hook for hook in HOOKS
+                              if callable(getattr(pl, hook, None))],
+                    'options': self._record_options(pl, cli),
+                })
+
+        return {'key': key, 'plugins': entries}
+
+    def _record_options(self, pl, cli):
+        setup = getattr(pl, 'setup', None)
+        if setup is None:
+            return []
+
+        recorder = _OptionRecorder(cli)
+        setup(recorder)
+
+        options = []
+        for command, option in recorder.options:
+            data = _dump_option(option)
+            if data is None:
+                log.debug('Cannot store option {} of plugin {} in manifest'
+                          .format(option.name, pl.PLUGIN_NAME))
+                return None
+            options.append((command, data))
+
+        return options
+
+    def _read_manifest(self, path):
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        if not isinstance(manifest, dict) or 'key' not in manifest:
+            return None
+        return manifest
+
+    def _write_manifest(self, path, manifest):
+        # written atomically, other instances may read it at the same time
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(manifest, f)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            log.debug('Could not write plugin manifest: {}'.format(e))
 
     def notify(self, funcname, *args, **kwargs):
-        rvs = []
+        """Calls the hook ``funcname`` of all plugins that define it.
+
+        Each hook runs in its own context, with ``current_plugin`` set. With
+        more than one worker, hooks run in separate threads as soon as all
+        plugins they depend on have finished, with ``concurrent`` set in
+        their context. If a hook raises an exception, no further hooks are
+        started and the exception is re-raised once the running ones have
+        finished.
+
+        Concurrent hooks share ``info``. A hook may only set keys owned by
+        its own plugin (usually named after it, e.g. ``info['egg_info']``)
+        and read those of plugins it depends on.
+
+        :return: A list of return values, in dependency order.
+        """
         order = self.resolve_order()
 
         log.debug('Sending {} signal to plugins in the following order: {}'
                   .format(funcname, order))
 
+        if self.workers > 1:
+            return self._notify_concurrent(order, funcname, args, kwargs)
+
+        rvs = []
         for plugin_name in order:
-            if not plugin_name in self.plugin_mods:
-                raise InvocationError(
-                    'Could not find plugin {}, which is required by {}'
-                    .format(plugin_name, self.get_dependants(plugin_name)))
+            func = self._get_hook(plugin_name, funcname)
+
+            if func is None:
+                continue
+
+            with new_local_stack() as nc:
+                nc['current_plugin'] = self.plugin_mods[plugin_name]
+                rvs.append(func(*args, **kwargs))
+
+        return rvs
+
+    def _get_hook(self, plugin_name, funcname):
+        if not plugin_name in self.plugin_mods:
+            raise InvocationError(
+                'Could not find plugin {}, which is required by {}'
+                .format(plugin_name, self.get_dependants(plugin_name)))
 
-            plugin = self.plugin_mods[plugin_name]
+        func = getattr(self.plugin_mods[plugin_name], funcname, None)
 
-            func = getattr(plugin, funcname, None)
+        if func is None or not callable(func):
+            return None
+        return func
 
-            if func is None or not callable(func):
+    def _notify_concurrent(self, order, funcname, args, kwargs):
+        # look up all hooks first, missing plugins are an error before
+        # anything runs
+        hooks = {name: self._get_hook(name, funcname) for name in order}
+        position = {name: i for i, name in enumerate(order)}
+        waiting = {name: set(self.get_dependencies(name)) for name in order}
+
+        ready = [name for name in order if not waiting[name]]
+        finished = Queue()
+        results = {}
+        running = 0
+        error = None
+        parent_ctx = _context.top
+
+        while ready or running:
+            while ready and running < self.workers and error is None:
+                name = ready.pop(0)
+
+                if hooks[name] is None:
+                    finished.put((name, None, None))
+                else:
+                    log.debug('Starting {}.{}'.format(name, funcname))
+                    # daemon threads do not keep an interrupted run alive
+                    thread = threading.Thread(target=self._run_hook, args=(
+                        parent_ctx, name, hooks[name], args, kwargs,
+                        finished))
+                    thread.daemon = True
+                    thread.start()
+                running += 1
+
+            if not running:
+                break
+
+            # waiting without a timeout cannot be interrupted on Python 2
+            while True:
+                try:
+                    name, rv, exc_info = finished.get(timeout=1)
+                    break
+                except Empty:
+                    pass
+            running -= 1
+
+            if exc_info is not None:
+                if error is None:
+                    error = exc_info
                 continue
 
-            rvs.append(func(*args, **kwargs))
+            if hooks[name] is not None:
+                results[name] = rv
 
-        return rvs
+            for dependant in self.get_dependants(name):
+                waiting[dependant].discard(name)
+                if not waiting[dependant]:
+                    ready.append(dependant)
+            ready.sort(key=position.__getitem__)
+
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+        return [results[name] for name in order if name in results]
+
+    def _run_hook(self, parent_ctx, plugin_name, func, args, kwargs,
+                  finished):
+        # context stacks are thread-local, start from the caller's context
+        _context.push(parent_ctx)
+        try:
+            with new_local_stack() as nc:
+                nc['current_plugin'] = self.plugin_mods[plugin_name]
+                nc['concurrent'] = True
+                rv = func(*args, **kwargs)
+        except:
+            finished.put((plugin_name, None, sys.exc_info()))
+        else:
+            finished.put((plugin_name, rv, None))
+        finally:
+            _context.pop()
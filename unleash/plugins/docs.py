@@ -111,13 +111,13 @@ def sphinx_build(ve, srcdir, outdir):
     ve.check_output(sphinx_args)
 
 
-def sphinx_install(ve):
+def sphinx_requirements():
     theme_pkgs = info['sphinx_theme_pkgs']
     log.debug('Will try to install the following theme packages: {}'
               .format(theme_pkgs))
 
-    # install sphinx and required theme packages
-    ve.pip_install('sphinx', *theme_pkgs)
+    # sphinx and required theme packages
+    return ['sphinx'] + list(theme_pkgs)
 
 
 def prepare_release():
@@ -134,19 +134,19 @@ def lint_release():
 
     log.info('Checking documentation builds cleanly')
 
-    # create doc virtualenv
-    with VirtualEnv.temporary() as ve, TempDir() as outdir:
-        try:
-            sphinx_install(ve)
-
+    try:
+        # create doc virtualenv while exporting the tree
+        with VirtualEnv.temporary_async(*sphinx_requirements()) as ve_task,\
+                TempDir() as outdir:
             # ensure documentation builds cleanly
             with in_tmpexport(commit) as srcdir:
+                ve = ve_task.result()
                 ve.pip_install(srcdir)
 
                 sphinx_build(ve, srcdir, outdir)
 
-        except subprocess.CalledProcessError as e:
-            issues.error('Error building documentation:\n{}'.format(e))
+    except subprocess.CalledProcessError as e:
+        issues.error('Error building documentation:\n{}'.format(e))
 
 
 def prepare_dev():
@@ -163,11 +163,13 @@ def publish_release():
 
     log.info('Uploading documentation to PyPI')
 
-        # create doc virtualenv
-        with VirtualEnv.temporary() as ve, in_tmpexport(commit) as srcdir:
-            try:
-                sphinx_install(ve)
-                ve.pip_install(srcdir)
-                ve.check_output([ve.python, 'setup.py', 'upload_docs'])
-            except subprocess.CalledProcessError as e:
-                issues.error('Error building documentation:\n{}'.format(e))
+    try:
+        # create doc virtualenv while exporting the tree
+        with VirtualEnv.temporary_async(*sphinx_requirements()) as ve_task,\
+                in_tmpexport(commit) as srcdir:
+            ve = ve_task.result()
+            ve.pip_install(srcdir)
+            ve.check_output([ve.python, 'setup.py', 'upload_docs'],
+                            cwd=srcdir)
+    except subprocess.CalledProcessError as e:
+        issues.error('Error building documentation:\n{}'.format(e))
@@ -1,3 +1,5 @@
+import subprocess
+
 from pkginfo import Develop
 from unleash import commit, log, info
 from unleash.util import VirtualEnv
@@ -7,9 +9,26 @@ from .utils_tree import in_tmpexport
 
 PLUGIN_NAME = 'egg_info'
 
+# egg_info only needs setup.py, the files it commonly reads and the python
+# sources. if that is not enough, the full tree is exported
+PLUGIN_EXPORT_PATHS = ['setup.py', 'setup.cfg', 'MANIFEST.in', 'README*',
+                       'LICENSE*', 'CHANGES*', 'CHANGELOG*', 'HISTORY*',
+                       'NEWS*', 'VERSION*', '*.txt', '*.rst', '*.md',
+                       '*.cfg', '*.ini', '*.toml', '*.json', '**/*.py']
+
+
+def _egg_info(ve, sparse):
+    with in_tmpexport(commit, sparse=sparse) as td:
+        ve.check_output([ve.python, 'setup.py', 'egg_info'], cwd=td)
+        return Develop(td)
+
 
 def collect_info():
     log.info('Collecting egg-info')
-    with VirtualEnv.temporary() as ve, in_tmpexport(commit):
-        ve.check_output([ve.python, 'setup.py', 'egg_info'])
-        info['egg_info'] = Develop('.')
+    with VirtualEnv.temporary() as ve:
+        try:
+            info['egg_info'] = _egg_info(ve, True)
+        except subprocess.CalledProcessError as e:
+            log.warning('setup.py egg_info failed on partial export, retrying '
+                        'with full export:\n{}'.format(e.output))
+            info['egg_info'] = _egg_info(ve, False)
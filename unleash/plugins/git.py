@@ -13,6 +13,12 @@ def setup(cli):
         ['--git-binary'], default='git',
         help='Path to git binary to use.'
     ))
+    cli.params.append(Option(
+        ['--git-cat-file/--no-git-cat-file'], default=False,
+        help='Read objects through a persistent "git cat-file --batch" '
+             'process of the git binary instead of dulwich. Faster on large '
+             'packfiles (default: disabled).'
+    ))
     cli.commands['publish'].params.append(Option(
         ['--git-remote'], default='origin',
         help='Remote to push release tags to (default: origin).',
@@ -1,22 +1,79 @@
 import os
 import subprocess
 
-from unleash import info, log, issues, commit
+from click import Option
+from tempdir import TempDir
+
+from unleash import info, log, issues, commit, opts
 from unleash.util import VirtualEnv
 from .utils_tree import in_tmpexport
 
 
 PLUGIN_NAME = 'setupdist'
-PLUGIN_DEPENDS = ['versions']
+PLUGIN_DEPENDS = ['versions', 'egg_info']
+
+
+def setup(cli):
+    cli.commands['release'].params.append(Option(
+        ['--sdist-from-tree/--no-sdist-from-tree'], default=False,
+        help='Build the source distribution directly from the git tree '
+        'instead of running setup.py sdist. Only use this if your source '
+        'distribution contains exactly the files in git (default: disabled).'
+    ))
 
 
 def _setup_py(ve, tmpdir, *args):
     a = [ve.python, os.path.join(tmpdir, 'setup.py')]
     a.extend(args)
-    return ve.check_output(a)
+    return ve.check_output(a, cwd=tmpdir)
+
+
+def _pkg_info(egg_info, version):
+    lines = [
+        'Metadata-Version: 1.1',
+        'Name: {}'.format(egg_info.name),
+        'Version: {}'.format(version),
+    ]
+
+    for field, value in [('Summary', egg_info.summary),
+                         ('Home-page', egg_info.home_page),
+                         ('Author', egg_info.author),
+                         ('Author-email', egg_info.author_email),
+                         ('License', egg_info.license)]:
+        lines.append(u'{}: {}'.format(field, value or 'UNKNOWN'))
+
+    for classifier in egg_info.classifiers:
+        lines.append(u'Classifier: {}'.format(classifier))
+
+    return u'\n'.join(lines).encode('utf8') + '\n'
+
+
+def _lint_tree_sdist():
+    log.info('Verifying release can install from an sdist of the git tree')
+
+    pkg_dir = '{}-{}'.format(info['pkg_name'], info['release_version'])
+    pkg_info = _pkg_info(info['egg_info'], info['release_version'])
+
+    with VirtualEnv.temporary() as ve, TempDir() as td:
+        fn = os.path.join(td, pkg_dir + '.tar.gz')
+
+        log.debug('Writing {}'.format(fn))
+        with open(fn, 'wb') as out:
+            commit.export_archive(out, prefix=pkg_dir + '/',
+                                  extra_files={'PKG-INFO': pkg_info})
+
+        try:
+            ve.pip_install(fn)
+        except subprocess.CalledProcessError as e:
+            issues.error('\'pip install\' of release failed:\n{}'.format(
+                e.output
+            ))
 
 
 def lint_release():
+    if opts['sdist_from_tree']:
+        return _lint_tree_sdist()
+
     log.info('Verifying release can generate source distribution')
     with VirtualEnv.temporary() as ve, in_tmpexport(commit) as td:
         log.debug('Running setup.py sdist')
@@ -32,9 +32,8 @@ def lint_release():
     log.info('Running tox tests')
     try:
         log.debug('Installing tox in a new virtualenv')
-        with VirtualEnv.temporary() as ve, in_tmpexport(commit):
-            ve.pip_install('tox')
+        with VirtualEnv.temporary('tox') as ve, in_tmpexport(commit) as td:
             log.debug('Running tests using tox')
-            ve.check_output(ve.get_binary('tox'))
+            ve.check_output(ve.get_binary('tox'), cwd=td)
     except subprocess.CalledProcessError as e:
         issues.error('tox testing failed:\n{}'.format(e.output))
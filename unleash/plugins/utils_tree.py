@@ -1,7 +1,9 @@
 from contextlib import contextmanager
 
-from tempdir import in_tempdir
-from unleash import issues, commit
+from tempdir import TempDir, in_tempdir
+from unleash import _context, issues, commit, export_cache, current_plugin
+from unleash.exc import InvocationError
+from unleash.git import ResolvedRef
 
 
 def require_file(path, error, suggestion=None):
@@ -12,8 +14,54 @@ def require_file(path, error, suggestion=None):
     return commit.get_path_data(path)
 
 
+def changed_since(ref, paths=None):
+    """Checks if the current commit differs from ``ref``.
+
+    Only the parts of the trees that differ are examined, so this is cheap
+    even for large repositories.
+
+    :param ref: Name or id of the commit to compare against, e.g. the last
+                release tag.
+    :param paths: Glob patterns to restrict the check to, e.g. ``['docs']``.
+    :raises InvocationError: If ``ref`` cannot be resolved or is ambiguous.
+    """
+    base = ResolvedRef(commit.repo, ref)
+
+    if not base.is_definite:
+        raise InvocationError('{} is ambiguous: {}'.format(base.ref,
+                                                           base.full_name))
+
+    if not base.found:
+        raise InvocationError('Could not resolve "{}"'.format(base.ref))
+
+    return commit.has_changes(base.peeled_id, paths)
+
+
 @contextmanager
-def in_tmpexport(commit):
-    with in_tempdir() as tmpdir:
-        commit.export_to(tmpdir)
-        yield tmpdir
+def in_tmpexport(commit, paths=None, sparse=True):
+    """Exports commit to a temporary directory and changes into it.
+
+    When hooks run concurrently (``--jobs`` larger than 1), the working
+    directory is shared by all of them and is not changed. Plugins should
+    pass the directory to subprocesses using ``cwd`` to work either way.
+
+    :param commit: Commit to export.
+    :param paths: Glob patterns of paths to export. If not given, the
+                  ``PLUGIN_EXPORT_PATHS`` of the currently running plugin are
+                  used; if it does not declare any, everything is exported.
+    :param sparse: If ``False``, everything is exported, ignoring ``paths``
+                   and ``PLUGIN_EXPORT_PATHS``.
+    """
+    if not sparse:
+        paths = None
+    elif paths is None:
+        paths = getattr(current_plugin, 'PLUGIN_EXPORT_PATHS', None)
+
+    if _context.top.get('concurrent'):
+        with TempDir() as tmpdir:
+            export_cache.export(commit, tmpdir, paths)
+            yield tmpdir
+    else:
+        with in_tempdir() as tmpdir:
+            export_cache.export(commit, tmpdir, paths)
+            yield tmpdir
@@ -1,24 +1,41 @@
+from . import current_plugin
 from .exc import PluginError
 
 
+def _current_plugin_name():
+    # name of the plugin whose hook is currently running, if any
+    try:
+        return current_plugin.PLUGIN_NAME
+    except (RuntimeError, KeyError, AttributeError):
+        return None
+
+
 class Issue(object):
     # severities are:
     #   warning  - can be ignored and still release
     #   error    - prevents releasing, issue with source
     #   critical - unexpected error, might be out of our hands or program bug
-    def __init__(self, channel, message, severity='warning', suggestion=None):
+    def __init__(self, channel, message, severity='warning', suggestion=None,
+                 plugin=None):
         assert severity in ('warning', 'error', 'critical')
         self.message = message
         self.severity = severity
         self.channel = channel
         self.suggestion = suggestion
+        self.plugin = plugin
+
+    @property
+    def source(self):
+        if self.plugin is None:
+            return self.channel
+        return u'{}:{}'.format(self.channel, self.plugin)
 
     def format_issue(self):
-        return u'[{}:{}] {}'.format(self.severity, self.channel, self.message)
+        return u'[{}:{}] {}'.format(self.severity, self.source, self.message)
 
     def format_suggestion(self):
         return u'[{}:{}] {}'.format(
-            self.severity, self.channel, self.suggestion
+            self.severity, self.source, self.suggestion
         )
 
     def __str__(self):
@@ -34,20 +51,23 @@ class ChannelReporter(object):
         self.collector.report(self.channel_name,
                               message,
                               severity='warning',
-                              suggestion=suggestion)
+                              suggestion=suggestion,
+                              plugin=_current_plugin_name())
 
     def error(self, message, suggestion=None):
         self.collector.report(self.channel_name,
                               message,
                               severity='error',
-                              suggestion=suggestion)
+                              suggestion=suggestion,
+                              plugin=_current_plugin_name())
         raise PluginError('Plugin reported error.')
 
     def critical(self, message, suggestion=None):
         self.collector.report(self.channel_name,
                               message,
                               severity='critical',
-                              suggestion=suggestion)
+                              suggestion=suggestion,
+                              plugin=_current_plugin_name())
         raise PluginError('Plugin reported critical error')
 
 
@@ -2,13 +2,14 @@ from pprint import pformat
 import time
 
 from dulwich.repo import Repo
-from dulwich.index import build_index_from_tree
 from logbook import Logger
 from tempdir import TempDir
 
 from . import new_local_stack, issues, opts, info, commit
 from .exc import InvocationError, PluginError
-from .git import MalleableCommit, ResolvedRef, get_local_timezone
+from .git import (GitCatFileStore, MalleableCommit, ObjectCache, ResolvedRef,
+                  RefsSnapshot, TagIndex, get_local_timezone,
+                  update_working_copy)
 from .report import IssueCollector
 from .util import run_user_shell, confirm_prompt
 
@@ -17,7 +18,7 @@ log = Logger('unleash')
 
 class Unleash(object):
     def _create_child_commit(self, parent_ref):
-        parent = ResolvedRef(self.repo, parent_ref)
+        parent = ResolvedRef(self.repo, parent_ref, refs=self.refs)
 
         if not parent.is_definite:
             raise InvocationError('{} is ambiguous: {}'.format(
@@ -29,7 +30,7 @@ class Unleash(object):
 
         # prepare the release commit
         commit = MalleableCommit.from_existing(
-            self.repo, parent.id
+            self.repo, parent.peeled_id, self.objects
         )
 
         # update author and such
@@ -52,7 +53,7 @@ class Unleash(object):
         commit.commit_time = now
         commit.commit_timezone = ltz
 
-        commit.parent_ids = [parent.id]
+        commit.parent_ids = [parent.peeled_id]
 
         return commit
 
@@ -61,8 +62,20 @@ class Unleash(object):
 
     def _init_repo(self):
         self.repo = Repo(opts['root'])
+        self.refs = RefsSnapshot(self.repo)
+
+        self.store = self.repo.object_store
+        if opts.get('git_cat_file'):
+            log.debug('Reading objects using git cat-file')
+            self.store = GitCatFileStore(self.repo, opts['git_binary'])
+
+        self.objects = ObjectCache(self.store, opts['object_cache_size'])
         self.gitconfig = self.repo.get_config_stack()
 
+    def close(self):
+        if isinstance(self.store, GitCatFileStore):
+            self.store.close()
+
     def _perform_step(self, signal_name):
         log.debug('begin: {}'.format(signal_name))
 
@@ -75,12 +88,13 @@ class Unleash(object):
 
         duration = time.time() - begin
 
-        log.debug('end: {}, took {:.4f}s'.format(signal_name, duration))
+        log.debug('end: {}, took {:.4f}s, {}'.format(signal_name, duration,
+                                                      self.objects))
 
     def create_release(self, ref):
         with new_local_stack() as nc:
             # resolve reference
-            base_ref = ResolvedRef(self.repo, ref)
+            base_ref = ResolvedRef(self.repo, ref, refs=self.refs)
             log.debug(
                 'Base ref: {} ({})'.format(base_ref.full_name, base_ref.id)
             )
@@ -143,7 +157,7 @@ class Unleash(object):
 
                 release_tag = 'refs/tags/{}'.format(info['release_version'])
 
-                if release_tag in self.repo.refs:
+                if release_tag in self.refs:
                     confirm_prompt(
                         'Repository already contains {}, really overwrite tag?'
                         .format(release_tag),
@@ -152,7 +166,7 @@ class Unleash(object):
                 release_hash = release_commit.save()
 
                 log.info('{}: {}'.format(release_tag, release_hash))
-                self.repo.refs[release_tag] = release_hash
+                self.refs[release_tag] = release_hash
 
                 # save the dev commit
                 dev_hash = nc['commit'].save()
@@ -166,7 +180,7 @@ class Unleash(object):
                                 'branch; dev commit will not be reachable.')
                     log.info('Dev commit: {}'.format(dev_hash))
                 else:
-                    self.repo.refs[base_ref.full_name] = dev_hash
+                    self.refs[base_ref.full_name] = dev_hash
 
                     # change the branch to point at our new dev commit
                     log.info('{}: {}'.format(
@@ -180,7 +194,7 @@ class Unleash(object):
                 return
 
     def _update_working_copy(self, base_ref, orig_tree):
-        head_ref = ResolvedRef(self.repo, 'HEAD')
+        head_ref = ResolvedRef(self.repo, 'HEAD', refs=self.refs)
         if not head_ref.is_definite or not head_ref.is_symbolic\
                 or not head_ref.target == base_ref.full_name:
             log.info('HEAD is not a symbolic ref to {}, leaving your '
@@ -210,33 +224,28 @@ class Unleash(object):
             'Do you want to reset your index to the new dev commit and check '
             'it out? Unsaved changes to your working copy may be overwritten!'
         )
-        log.info('Resetting index and checking out dev commit.')
-        build_index_from_tree(
-            self.repo.path,
-            self.repo.index_path(),
-            self.repo.object_store,
+        log.info('Updating index and working copy to dev commit.')
+        num_changed = update_working_copy(
+            self.repo,
+            orig_tree,
             base_ref.get_object().tree,
         )
+        log.debug('Updated {} paths in working copy'.format(num_changed))
 
     def publish(self, ref):
         if ref is None:
-            tags = sorted(
-                (t for t in self.repo.refs.as_dict().iteritems() if
-                 t[0].startswith('refs/tags')),
-                key=lambda (_, sha): self.repo[sha].commit_time,
-                reverse=True,
-            )
+            ref = TagIndex(self.repo, self.refs).newest()
 
-            if not tags:
+            if ref is None:
                 log.error('Could not find a tag to publish.')
                 return
 
-            ref = tags[0][0]
-
-        pref = ResolvedRef(self.repo, ref)
+        pref = ResolvedRef(self.repo, ref, refs=self.refs)
 
         with new_local_stack() as nc:
-            nc['commit'] = MalleableCommit.from_existing(self.repo, pref.id)
+            # release tags are usually annotated
+            nc['commit'] = MalleableCommit.from_existing(
+                self.repo, pref.peeled_id, self.objects)
             log.debug('Release tag: {}'.format(commit))
 
             nc['issues'] = IssueCollector(log=log)
@@ -1,16 +1,30 @@
+from collections import OrderedDict, deque, namedtuple
 from contextlib import contextmanager
+from functools import partial
+import hashlib
+import json
 import os
+import re
+import shutil
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 
 import click
 import logbook
 from tempdir import TempDir
-from unleash import opts
-import virtualenv
+from . import _context, opts, venv_pool, wheelhouse
 
 
 log = logbook.Logger('util')
 
+# a requirement given by project name, with optional extras, version
+# specifiers and environment markers
+REQUIREMENT_RE = re.compile(r'^\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*'
+                            r'(\[[^\]]*\])?([^;@/]*)(;.*)?$', re.S)
+
 
 class VirtualEnv(object):
     def __init__(self, path):
@@ -25,6 +39,25 @@ class VirtualEnv(object):
         return self.get_binary('python')
 
     def check_output(self, *args, **kwargs):
+        """Runs a command inside the virtualenv and returns its standard
+        output. Standard error is only logged, see
+        :func:`~unleash.util.run_command`."""
+        return self.run_command(*args, capture_stdout=True, **kwargs).stdout
+
+    def run_command(self, *args, **kwargs):
+        """Runs a command inside the virtualenv, see
+        :func:`~unleash.util.run_command`."""
+        return run_command(*args, **self._command_kwargs(kwargs))
+
+    def check_output_async(self, *args, **kwargs):
+        """Like :meth:`check_output`, but returns a
+        :class:`~unleash.util.CommandTask` running the command, whose result
+        is the standard output."""
+        kwargs.setdefault('finish', _stdout_of)
+        return CommandTask(*args, capture_stdout=True,
+                           **self._command_kwargs(kwargs))
+
+    def _command_kwargs(self, kwargs):
         env = {}
         env.update(kwargs.pop('env', {}))
 
@@ -35,38 +68,933 @@ class VirtualEnv(object):
         ])
         kwargs['env'] = env
 
-        return subprocess.check_output(*args, **kwargs)
+        return kwargs
 
     def get_binary(self, name):
         return os.path.join(self.path, 'bin', name)
 
     def pip_install(self, *pkgs):
-        return self.check_output([
-            self.pip,
-            'install',
-        ] + list(pkgs))
+        """Installs packages using the current
+        :class:`~unleash.util.Wheelhouse`."""
+        return wheelhouse.install(self, *pkgs)
+
+    def pip_install_async(self, *pkgs):
+        """Like :meth:`pip_install`, but returns a
+        :class:`~unleash.util.CommandTask` installing the packages, see
+        :meth:`Wheelhouse.install_async`."""
+        return wheelhouse.install_async(self, *pkgs)
 
     @classmethod
     def create(cls, path):
+        # virtualenv is large, only import it when needed
+        import virtualenv
         virtualenv.create_environment(path)
         return cls(path)
 
     @classmethod
     @contextmanager
-    def temporary(cls):
+    def temporary(cls, *requirements):
+        """Creates a virtualenv that is removed afterwards.
+
+        The virtualenv is cloned from a template of the current
+        :class:`~unleash.util.VirtualEnvPool`, which has ``requirements``
+        installed already.
+
+        :param requirements: Packages to install, as passed to pip.
+        """
+        with TempDir() as tmpdir:
+            yield venv_pool.clone(tmpdir, requirements)
+
+    @classmethod
+    @contextmanager
+    def temporary_async(cls, *requirements):
+        """Like :meth:`temporary`, but creates the virtualenv in the
+        background. Yields a :class:`~unleash.util.BackgroundTask`, whose
+        result is the virtualenv."""
         with TempDir() as tmpdir:
-            yield cls.create(tmpdir)
+            task = BackgroundTask(venv_pool.clone, tmpdir, requirements)
+            try:
+                yield task
+            finally:
+                # the directory must not be removed while still being set up
+                task.wait()
 
     def __str__(self):
         return '{}({!r})'.format(self.__class__.__name__, self.path)
 
 
+def user_cache_dir(*parts):
+    """Returns the path of a directory (below) unleash's cache directory.
+
+    The cache directory follows the XDG base directory specification, i.e.
+    it is ``$XDG_CACHE_HOME/unleash`` or ``~/.cache/unleash``. Directories are
+    not created.
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'unleash', *parts)
+
+
+class BackgroundTask(object):
+    """Calls ``func(*args, **kwargs)`` in a separate thread.
+
+    Allows a plugin to do slow work that is not a single external command,
+    like setting up a virtualenv, while doing other work. The thread sees the
+    context of the caller, e.g. :data:`~unleash.opts`, but must not modify
+    it. External commands should use :class:`~unleash.util.CommandTask`.
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        self._result = None
+        self._exc_info = None
+        self._thread = threading.Thread(target=self._run, args=(
+            _context.top, func, args, kwargs))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, parent_ctx, func, args, kwargs):
+        # context stacks are thread-local, start from the caller's context
+        _context.push(parent_ctx)
+        try:
+            self._result = func(*args, **kwargs)
+        except:
+            self._exc_info = sys.exc_info()
+        finally:
+            _context.pop()
+
+    def done(self):
+        return not self._thread.is_alive()
+
+    def wait(self, timeout=None):
+        """Waits for the task to finish.
+
+        :param timeout: Maximum number of seconds to wait, ``None`` to wait
+                        until finished.
+        :return: ``True`` if the task has finished.
+        """
+        if timeout is not None:
+            self._thread.join(timeout)
+        else:
+            # joining without a timeout cannot be interrupted on Python 2
+            while not self.done():
+                self._thread.join(1)
+        return self.done()
+
+    def result(self):
+        """Waits for the task to finish and returns the result of ``func``.
+        If ``func`` raised an exception, it is raised again here."""
+        self.wait()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+def _normalize_requirement(req):
+    m = REQUIREMENT_RE.match(req)
+    if m is None or Wheelhouse.is_local(req):
+        return req
+
+    name, extras, specifiers, markers = m.groups()
+    return ''.join([
+        re.sub(r'[-_.]+', '-', name).lower(),
+        ''.join((extras or '').split()),
+        ''.join(specifiers.split()),
+        (markers or '').strip(),
+    ])
+
+
+class VirtualEnvPool(object):
+    """Hands out fresh virtualenvs, cloned from cached templates.
+
+    Creating a virtualenv installs setuptools and pip every time, which takes
+    seconds, installing packages like sphinx or tox into it takes even
+    longer. Instead, relocatable templates are created once per interpreter
+    and set of requirements, then kept in ``path`` across runs. Each
+    virtualenv handed out is a copy of a template, see
+    :func:`~unleash.util.copy_tree`, which is discarded by its user. Copies
+    are not hardlinked, as pip and setuptools rewrite some files like
+    ``easy-install.pth`` in place, which would alter the template.
+
+    :param path: Directory to keep templates in. If ``None``, every
+                 virtualenv is created from scratch instead.
+    :param max_size: Maximum size of all templates in bytes. When exceeded,
+                     the least recently used templates are removed. ``None``
+                     means unlimited.
+    :param max_age: Templates with requirements are recreated after this
+                    many seconds, to pick up new releases of unpinned
+                    requirements.
+    """
+
+    def __init__(self, path=None, max_size=None, max_age=7 * 24 * 60 * 60):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    @staticmethod
+    def normalize_requirements(requirements):
+        """Returns a sorted list of unique requirements, with project names
+        normalized like pip does. URLs, paths and other requirements not
+        starting with a project name are left untouched."""
+        return sorted(set(_normalize_requirement(r) for r in requirements))
+
+    def _key(self, requirements):
+        import virtualenv
+
+        # a template is only valid for the interpreter and virtualenv
+        # version it was created with
+        return hashlib.sha1('\0'.join([
+            os.path.realpath(sys.executable), sys.version,
+            virtualenv.__version__] + requirements)).hexdigest()
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _read_meta(self, key):
+        try:
+            with open(os.path.join(self.path, key + '.json')) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _get_template(self, requirements):
+        # must be called with the lock for the template's key held
+        key = self._key(requirements)
+        meta = self._read_meta(key)
+
+        if meta is not None and requirements and (
+                time.time() - meta['created'] > self.max_age):
+            log.debug('Virtualenv template {} expired'.format(key))
+            meta = None
+
+        if meta is None:
+            meta = self._create_template(key, requirements)
+        else:
+            # the modification time of the metadata is used for eviction
+            os.utime(os.path.join(self.path, key + '.json'), None)
+
+        return os.path.join(self.path, key), meta
+
+    def _create_template(self, key, requirements):
+        import virtualenv
+
+        path = os.path.join(self.path, key)
+        log.info('Creating virtualenv template with requirements {} in {}'
+                 .format(requirements, path))
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        # other processes may create the same template at the same time,
+        # it is only moved into place once complete
+        tmpdir = TempDir(prefix='tmp-', basedir=self.path)
+        try:
+            tmp_path = os.path.join(tmpdir.name, 'venv')
+
+            if requirements:
+                with self._key_lock(self._key([])):
+                    base, base_meta = self._get_template([])
+                    os.mkdir(tmp_path)
+                    self._copy(base, base_meta, tmp_path)
+                VirtualEnv(tmp_path).pip_install(*requirements)
+            else:
+                VirtualEnv.create(tmp_path)
+
+            virtualenv.make_environment_relocatable(tmp_path)
+
+            meta = {
+                'requirements': requirements,
+                'created': time.time(),
+                'origin': tmp_path,
+                'size': tree_size(tmp_path),
+            }
+
+            # remove the metadata first, making the template invalid while
+            # an expired one is being replaced
+            meta_path = os.path.join(self.path, key + '.json')
+            if os.path.exists(meta_path):
+                os.unlink(meta_path)
+            if os.path.exists(path):
+                os.rename(path, os.path.join(tmpdir.name, 'old'))
+            os.rename(tmp_path, path)
+
+            with open(os.path.join(tmpdir.name, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+            os.rename(os.path.join(tmpdir.name, 'meta.json'), meta_path)
+        finally:
+            tmpdir.dissolve()
+
+        return meta
+
+    def _copy(self, template, meta, dest):
+        copy_tree(template, dest)
+
+        # some symlinks, like local/bin on Debian, are absolute and point to
+        # where the template was created
+        origin = meta['origin']
+        for dirpath, dirnames, filenames in os.walk(dest):
+            for name in dirnames + filenames:
+                link = os.path.join(dirpath, name)
+                if not os.path.islink(link):
+                    continue
+
+                target = os.readlink(link)
+                if target == origin or target.startswith(origin + '/'):
+                    os.unlink(link)
+                    os.symlink(dest + target[len(origin):], link)
+
+    def clone(self, dest, requirements=()):
+        """Creates a new virtualenv in ``dest``.
+
+        :param dest: Existing, empty directory.
+        :param requirements: Packages to install into the virtualenv, as
+                             passed to pip.
+        :return: A :class:`~unleash.util.VirtualEnv`.
+        """
+        if self.path is None:
+            ve = VirtualEnv.create(dest)
+            if requirements:
+                ve.pip_install(*requirements)
+            return ve
+
+        requirements = self.normalize_requirements(requirements)
+        key = self._key(requirements)
+
+        start = time.time()
+        with self._key_lock(key):
+            template, meta = self._get_template(requirements)
+            self._copy(template, meta, dest)
+
+        log.debug('Cloned virtualenv template {} into {} in {:.2f}s'.format(
+            key, dest, time.time() - start))
+
+        self._evict(key)
+        return VirtualEnv(dest)
+
+    def _evict(self, keep):
+        if self.max_size is None:
+            return
+
+        templates = []
+        for name in os.listdir(self.path):
+            key, ext = os.path.splitext(name)
+            meta = self._read_meta(key) if ext == '.json' else None
+            if meta is not None:
+                mtime = os.path.getmtime(os.path.join(self.path, name))
+                templates.append((mtime, key, meta['size']))
+
+        size = sum(t[2] for t in templates)
+
+        # least recently used first
+        for mtime, key, template_size in sorted(templates):
+            if size <= self.max_size:
+                break
+            if key == keep:
+                continue
+
+            # templates in use by other threads are skipped
+            lock = self._key_lock(key)
+            if not lock.acquire(False):
+                continue
+
+            try:
+                log.debug('Evicting virtualenv template {}'.format(key))
+                os.unlink(os.path.join(self.path, key + '.json'))
+                shutil.rmtree(os.path.join(self.path, key),
+                              ignore_errors=True)
+                size -= template_size
+            finally:
+                lock.release()
+
+
+class Wheelhouse(object):
+    """Local directory of wheels that packages are installed from.
+
+    Before installing, wheels for the requested packages and all of their
+    dependencies are added to the wheelhouse using ``pip wheel``, which only
+    downloads or builds those not found in it already. The packages are then
+    installed from the wheelhouse only. Wheels are moved into place once
+    complete, so a wheelhouse can be shared by concurrent installs.
+
+    Local directories and archives, like the project being released, are
+    never added. They are installed directly, with their dependencies taken
+    from the wheelhouse where available.
+
+    :param path: Directory containing the wheels. If ``None``, packages are
+                 installed from the package index directly.
+    :param offline: Never access the package index, install packages missing
+                    from the wheelhouse fails instead.
+    """
+
+    def __init__(self, path=None, offline=False):
+        self.path = path
+        self.offline = offline
+
+    #: Suffixes of archives pip can install from.
+    ARCHIVE_SUFFIXES = ('.whl', '.zip', '.tar.gz', '.tgz', '.tar.bz2',
+                        '.tbz', '.tar.xz', '.txz', '.tar')
+
+    @classmethod
+    def is_local(cls, pkg):
+        """Checks if ``pkg`` refers to a local directory or archive instead
+        of a requirement. Like pip, only paths containing a separator and
+        archive names are considered; a directory named like a requirement,
+        e.g. ``tox`` in the current directory, does not count."""
+        if '://' in pkg:
+            return False
+        return (os.path.isabs(pkg) or os.sep in pkg
+                or pkg.lower().endswith(cls.ARCHIVE_SUFFIXES))
+
+    def add(self, ve, *pkgs):
+        """Adds wheels for ``pkgs`` and their dependencies.
+
+        :param ve: :class:`~unleash.util.VirtualEnv` to run pip in.
+        """
+        tmpdir = self._wheel_dir()
+        try:
+            ve.check_output(self._wheel_args(ve, tmpdir.name, pkgs))
+            self._keep_wheels(tmpdir.name)
+        finally:
+            tmpdir.dissolve()
+
+    def install(self, ve, *pkgs):
+        """Installs ``pkgs`` into a virtualenv.
+
+        :param ve: :class:`~unleash.util.VirtualEnv` to install into.
+        :param pkgs: Requirements or paths, as passed to pip.
+        """
+        reqs, no_index = self._plan(pkgs)
+
+        if reqs:
+            try:
+                self.add(ve, *reqs)
+            except subprocess.CalledProcessError as e:
+                self._add_failed(reqs, e)
+                no_index = False
+
+        return ve.check_output(self._install_args(ve, pkgs, no_index))
+
+    def install_async(self, ve, *pkgs):
+        """Like :meth:`install`, but returns a
+        :class:`~unleash.util.CommandTask`.
+
+        Adding wheels, which downloads and builds packages, runs in the
+        background. The final ``pip install`` from the wheelhouse is quick
+        and runs once the result of the task is requested, which must always
+        happen to clean up.
+        """
+        reqs, no_index = self._plan(pkgs)
+
+        if not reqs:
+            return ve.check_output_async(
+                self._install_args(ve, pkgs, no_index))
+
+        tmpdir = self._wheel_dir()
+
+        def finish(result, error):
+            try:
+                if error is None:
+                    self._keep_wheels(tmpdir.name)
+                else:
+                    self._add_failed(reqs, error)
+            finally:
+                tmpdir.dissolve()
+
+            return ve.check_output(
+                self._install_args(ve, pkgs, no_index and error is None))
+
+        try:
+            return ve.check_output_async(
+                self._wheel_args(ve, tmpdir.name, reqs), finish=finish)
+        except:
+            tmpdir.dissolve()
+            raise
+
+    def _plan(self, pkgs):
+        # returns the requirements to add to the wheelhouse first and
+        # whether the package index can be skipped
+        if self.path is None:
+            return [], False
+
+        reqs = [pkg for pkg in pkgs if not self.is_local(pkg)]
+
+        # the dependencies of local packages are unknown until they are
+        # built, so they may still need the package index
+        no_index = self.offline or len(reqs) == len(pkgs)
+
+        return ([] if self.offline else reqs), no_index
+
+    def _wheel_dir(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        return TempDir(prefix='tmp-', basedir=self.path)
+
+    def _wheel_args(self, ve, wheel_dir, pkgs):
+        return [
+            ve.pip, 'wheel',
+            '--wheel-dir', wheel_dir,
+            '--find-links', self.path,
+        ] + list(pkgs)
+
+    def _keep_wheels(self, wheel_dir):
+        for name in os.listdir(wheel_dir):
+            os.rename(os.path.join(wheel_dir, name),
+                      os.path.join(self.path, name))
+
+    def _add_failed(self, reqs, e):
+        # not every package can be built as a wheel
+        log.warning('Could not add {} to wheelhouse, installing from '
+                    'package index:\n{}'.format(' '.join(reqs), e.output))
+
+    def _install_args(self, ve, pkgs, no_index):
+        args = [ve.pip, 'install']
+
+        if self.path is not None:
+            args.extend(['--find-links', self.path])
+        if no_index:
+            args.append('--no-index')
+
+        log.debug('Installing {} into {}'.format(' '.join(pkgs), ve))
+        return args + list(pkgs)
+
+
+def copy_tree(src, dest, link=False):
+    """Copies the contents of directory ``src`` into directory ``dest``.
+
+    Unless ``link`` is set, ``cp --reflink=auto`` is used, which creates
+    copy-on-write clones on filesystems supporting it. If ``cp`` is not
+    available or does not support reflinks, files are copied manually.
+
+    :param src: Source directory.
+    :param dest: Existing destination directory.
+    :param link: If ``True``, hardlink files instead of copying them.
+    """
+    if not link:
+        try:
+            with open(os.devnull, 'wb') as devnull:
+                subprocess.check_call(
+                    ['cp', '-a', '--reflink=auto', os.path.join(src, '.'),
+                     dest],
+                    stderr=devnull)
+            return
+        except (OSError, subprocess.CalledProcessError):
+            log.debug('cp --reflink failed, falling back to manual copy')
+
+    for dirpath, dirnames, filenames in os.walk(src):
+        target = os.path.join(dest, os.path.relpath(dirpath, src))
+
+        for name in dirnames + filenames:
+            src_path = os.path.join(dirpath, name)
+            dest_path = os.path.join(target, name)
+
+            if os.path.islink(src_path):
+                os.symlink(os.readlink(src_path), dest_path)
+            elif os.path.isdir(src_path):
+                os.mkdir(dest_path)
+                shutil.copymode(src_path, dest_path)
+            elif link:
+                os.link(src_path, dest_path)
+            else:
+                shutil.copy2(src_path, dest_path)
+
+
+def tree_size(path):
+    """Returns the total size of all files below ``path`` in bytes."""
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            size += os.lstat(os.path.join(dirpath, name)).st_size
+    return size
+
+
+class ExportCache(object):
+    """Cache for exported commit trees, shared by all plugins of a run.
+
+    Every tree is exported only once into a cache directory, keyed by its
+    SHA1 and the paths selected for sparse exports. Callers always receive a
+    private copy, created by :func:`~unleash.util.copy_tree`, so no caller can
+    alter another one's checkout.
+
+    :param max_size: Maximum size of all cached exports in bytes. When
+                     exceeded, the least recently used exports are evicted.
+                     ``None`` means unlimited, ``0`` disables caching.
+    :param link: Hardlink files instead of copying them. This is only safe
+                 if no consumer modifies exported files in place.
+    :param max_file_size: Files larger than this many bytes are left out of
+                          exports.
+
+    The cache may be used by plugins running concurrently; exports through
+    the cache are serialized.
+    """
+
+    def __init__(self, max_size=None, link=False, max_file_size=None):
+        self.max_size = max_size
+        self.link = link
+        self.max_file_size = max_file_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._num_exports = 0
+        self._tmpdir = None
+        self._lock = threading.Lock()
+
+    def export(self, commit, dest, paths=None):
+        """Exports the tree of ``commit`` to the directory ``dest``.
+
+        :param commit: A :class:`~unleash.git.MalleableCommit`.
+        :param dest: Existing, empty output directory.
+        :param paths: Glob patterns for a sparse export, see
+                      :class:`~unleash.git.TreeExporter`.
+        """
+        if self.max_size == 0:
+            commit.export_to(dest, paths=paths,
+                             max_file_size=self.max_file_size)
+            return
+
+        with self._lock:
+            self._export(commit, dest, paths)
+
+    def _export(self, commit, dest, paths):
+        key = (commit.tree.id, tuple(paths) if paths is not None else None)
+
+        if key in self._entries:
+            log.debug('Export cache hit for tree {}'.format(key[0]))
+            entry = self._entries.pop(key)
+        else:
+            log.debug('Export cache miss for tree {}'.format(key[0]))
+            if self._tmpdir is None:
+                self._tmpdir = TempDir(prefix='unleash-export-')
+
+            path = os.path.join(self._tmpdir.name, str(self._num_exports))
+            self._num_exports += 1
+            os.mkdir(path)
+
+            # most trees in a run differ only in a few files, so updating
+            # a copy of the last export is cheaper than a full export. the
+            # base tree may only exist in another commit's unsaved objects
+            base = next((k for k in reversed(self._entries)
+                         if k[1] == key[1] and commit.has_object(k[0])),
+                        None)
+
+            if base is not None:
+                copy_tree(self._entries[base][0], path)
+                commit.export_to(path, base_tree_id=base[0], paths=paths,
+                                 max_file_size=self.max_file_size)
+            else:
+                commit.export_to(path, paths=paths,
+                                 max_file_size=self.max_file_size)
+
+            entry = (path, tree_size(path))
+            self.size += entry[1]
+
+        # most recently used entries are kept at the end
+        self._entries[key] = entry
+        copy_tree(entry[0], dest, self.link)
+
+        self._evict()
+
+    def _evict(self):
+        while (self.max_size is not None and self.size > self.max_size
+               and self._entries):
+            key, (path, size) = self._entries.popitem(last=False)
+            log.debug('Evicting tree {} from export cache'.format(key[0]))
+            shutil.rmtree(path)
+            self.size -= size
+
+    def close(self):
+        """Removes all cached exports."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+            if self._tmpdir is not None:
+                self._tmpdir.dissolve()
+                self._tmpdir = None
+
+
+#: Number of bytes of output kept by :func:`~unleash.util.run_command`.
+OUTPUT_TAIL_SIZE = 64 * 1024
+
+CommandResult = namedtuple('CommandResult',
+                           'args output returncode wall_time cpu_time stdout')
+
+
+class OutputTail(object):
+    """Keeps the last ``max_size`` bytes of lines appended to it."""
+
+    def __init__(self, max_size=OUTPUT_TAIL_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.omitted = 0
+        self._lines = deque()
+
+    def append(self, line):
+        self._lines.append(line)
+        self.size += len(line)
+
+        while self.size > self.max_size:
+            excess = self.size - self.max_size
+            first = self._lines[0]
+
+            if len(first) > excess and len(self._lines) == 1:
+                # a single line longer than the limit is cut
+                self._lines[0] = first[excess:]
+                removed = excess
+            else:
+                self._lines.popleft()
+                removed = len(first)
+
+            self.size -= removed
+            self.omitted += removed
+
+    def getvalue(self):
+        output = ''.join(self._lines)
+        if self.omitted:
+            return '[{} bytes of output omitted]\n{}'.format(self.omitted,
+                                                           output)
+        return output
+
+
+def _read_output(pipe, name, tail, lock, lines=None):
+    try:
+        # reading at most tail.max_size bytes at once bounds memory use even
+        # for output without newlines
+        for line in iter(partial(pipe.readline, tail.max_size), ''):
+            log.debug('{}: {}'.format(name, line.rstrip('\n')))
+            with lock:
+                tail.append(line)
+            if lines is not None:
+                lines.append(line)
+    finally:
+        pipe.close()
+
+
+def run_command(args, *popen_args, **kwargs):
+    """Runs a command, streaming its output to the debug log.
+
+    Standard output and error are combined. Instead of the whole output,
+    only its last ``tail_size`` bytes are kept.
+
+    :param args: Command to run, as passed to :class:`subprocess.Popen`.
+    :param tail_size: Number of bytes of output to keep.
+    :param capture_stdout: If ``True``, standard output is also kept
+                           completely and separately from standard error, as
+                           the ``stdout`` of the result.
+    :param popen_args: Passed on to :class:`subprocess.Popen`, like all other
+                       keyword arguments.
+    :return: A :class:`~unleash.util.CommandResult`, containing the end of
+             the output, exit status, wall and CPU time in seconds.
+    :raises subprocess.CalledProcessError: If the command exits with a
+                                           non-zero status. Its ``output`` is
+                                           the end of the command's output.
+    """
+    tail_size = kwargs.pop('tail_size', OUTPUT_TAIL_SIZE)
+    capture_stdout = kwargs.pop('capture_stdout', False)
+
+    if isinstance(args, basestring):
+        args = [args]
+    name = os.path.basename(args[0])
+    tail = OutputTail(tail_size)
+    tail_lock = threading.Lock()
+    stdout = [] if capture_stdout else None
+
+    log.debug('Running {}'.format(' '.join(args)))
+    start = time.time()
+    proc = subprocess.Popen(args, *popen_args, stdout=subprocess.PIPE,
+                            stderr=(subprocess.PIPE if capture_stdout
+                                    else subprocess.STDOUT),
+                            **kwargs)
+
+    try:
+        if capture_stdout:
+            # both pipes must be drained at the same time, or the command
+            # blocks once the buffer of the other one is full
+            stderr_reader = threading.Thread(
+                target=_read_output,
+                args=(proc.stderr, name, tail, tail_lock))
+            stderr_reader.daemon = True
+            stderr_reader.start()
+
+        _read_output(proc.stdout, name, tail, tail_lock, stdout)
+
+        if capture_stdout:
+            stderr_reader.join()
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+
+    rusage = _reap(proc, 0)
+    return _command_result(args, proc, rusage, time.time() - start, tail,
+                           stdout)
+
+
+def _reap(proc, options):
+    # unlike Popen.wait(), wait4 reports resources used by the child.
+    # returns None if options contain WNOHANG and proc is still running
+    pid, status, rusage = os.wait4(proc.pid, options)
+    if not pid:
+        return None
+
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return rusage
+
+
+def _command_result(args, proc, rusage, wall_time, tail, stdout):
+    result = CommandResult(args, tail.getvalue(), proc.returncode, wall_time,
+                           rusage.ru_utime + rusage.ru_stime,
+                           ''.join(stdout) if stdout is not None else None)
+    log.debug('{} exited with status {} after {:.2f}s ({:.2f}s CPU)'.format(
+        os.path.basename(args[0]), result.returncode, result.wall_time,
+        result.cpu_time))
+
+    if result.returncode:
+        raise subprocess.CalledProcessError(result.returncode, args,
+                                            result.output)
+    return result
+
+
+def _stdout_of(result, error):
+    if error is not None:
+        raise error
+    return result.stdout
+
+
+class CommandTask(object):
+    """Runs an external command in the background, without a thread.
+
+    Output is written to temporary files, so the command never blocks on a
+    full pipe. It is logged and cut to its tail only once the command has
+    exited and :meth:`result` is called. With ``capture_stdout``, the tail
+    holds standard output followed by standard error, as their order is
+    unknown. Arguments are those of :func:`~unleash.util.run_command`.
+
+    :param finish: Called as ``finish(result, error)`` once the command has
+                   exited, with either the
+                   :class:`~unleash.util.CommandResult` or the
+                   :class:`~subprocess.CalledProcessError` raised for it.
+                   Its return value becomes the result of the task. It runs
+                   in the thread calling :meth:`result`.
+    """
+
+    #: Seconds between checks whether the command has exited.
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, args, *popen_args, **kwargs):
+        self.tail_size = kwargs.pop('tail_size', OUTPUT_TAIL_SIZE)
+        self.capture_stdout = kwargs.pop('capture_stdout', False)
+        self.finish = kwargs.pop('finish', None)
+
+        if isinstance(args, basestring):
+            args = [args]
+        self.args = args
+        self._rusage = None
+        self._end = None
+        self._outcome = None
+
+        self._stdout = tempfile.TemporaryFile()
+        self._stderr = (tempfile.TemporaryFile() if self.capture_stdout
+                        else None)
+
+        log.debug('Running {} in the background'.format(' '.join(args)))
+        self._start = time.time()
+        try:
+            self._proc = subprocess.Popen(
+                args, *popen_args, stdout=self._stdout,
+                stderr=self._stderr or subprocess.STDOUT, **kwargs)
+        except:
+            self._close()
+            raise
+
+    def done(self):
+        """Checks if the command has exited, without blocking."""
+        if self._rusage is None:
+            self._rusage = _reap(self._proc, os.WNOHANG)
+            self._end = time.time()
+        return self._rusage is not None
+
+    def wait(self, timeout=None):
+        """Waits for the command to exit.
+
+        :param timeout: Maximum number of seconds to wait, ``None`` to wait
+                        until finished.
+        :return: ``True`` if the command has exited.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+
+        try:
+            while not self.done():
+                if deadline is not None and time.time() >= deadline:
+                    return False
+                time.sleep(self.POLL_INTERVAL)
+        except BaseException:
+            if not self.done():
+                self._proc.kill()
+                self._rusage = _reap(self._proc, 0)
+                self._end = time.time()
+            raise
+
+        return True
+
+    def result(self):
+        """Waits for the command to exit and returns its
+        :class:`~unleash.util.CommandResult`, or the return value of
+        ``finish``.
+
+        :raises subprocess.CalledProcessError: If the command failed and no
+                                               ``finish`` was given.
+        """
+        self.wait()
+
+        if self._outcome is None:
+            try:
+                self._outcome = self._finish(), None
+            except:
+                self._outcome = None, sys.exc_info()
+
+        value, exc_info = self._outcome
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return value
+
+    def _finish(self):
+        name = os.path.basename(self.args[0])
+        tail = OutputTail(self.tail_size)
+        tail_lock = threading.Lock()
+        stdout = [] if self.capture_stdout else None
+
+        try:
+            for f, lines in [(self._stdout, stdout), (self._stderr, None)]:
+                if f is not None:
+                    f.seek(0)
+                    _read_output(f, name, tail, tail_lock, lines)
+        finally:
+            self._close()
+
+        try:
+            result = _command_result(self.args, self._proc, self._rusage,
+                                     self._end - self._start, tail, stdout)
+            error = None
+        except subprocess.CalledProcessError as e:
+            if self.finish is None:
+                raise
+            result, error = None, e
+
+        if self.finish is not None:
+            return self.finish(result, error)
+        return result
+
+    def _close(self):
+        self._stdout.close()
+        if self._stderr is not None:
+            self._stderr.close()
+
+
 def checked_output(cmd, *args, **kwargs):
     try:
-        log.debug('run %s' % ' '.join(cmd))
-        return subprocess.check_output(
-            cmd, *args, stderr=subprocess.STDOUT, **kwargs
-        )
+        return run_command(cmd, *args, **kwargs).output
     except subprocess.CalledProcessError as e:
         log.error('Error calling external process.\n%s' % e.output)
         raise